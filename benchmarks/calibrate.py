@@ -0,0 +1,128 @@
+"""
+    Times the calibration pulse-height extraction: the old python loop over the triggers against calibration_peaks
+    Checks the two give the same histograms, for both the peak heights and the pedestal-subtracted sums
+
+    Like calibrate, the loop gets the waveforms in mV and calibration_peaks gets the raw ADC counts. The old calibrate paid for that 
+    conversion in measure(), so the loop is timed both with it (from the ADC buffers, which is what calibrate sees) and without it 
+    (just the window extraction). Each is the best of `repeats` runs. Fails if calibrate isn't at least `target` times faster 
+    from the ADC buffers
+
+    Run from the top of the repo with
+        python -m benchmarks.calibrate [samples] [sample interval ns] [repeats] [target speedup]
+"""
+import ctypes
+import sys
+import time
+
+import numpy as np
+
+from wms_midas.utilities.read_pico import calibration_peaks, adc2mV, mV2adc, channelInputRanges
+
+# the ranges PicoMeasure uses: 2 V on the sync, 200 mV on the monitor and receiver
+RANGES = (7, 4, 4)
+MAX_ADC = ctypes.c_int16(32512)
+
+def loop_peaks(trigger, chanb, chand, dt, peak=True):
+    """
+        What PicoMeasure.calibrate used to do: slice out the window after every trigger, one at a time
+    """
+    crossings = np.diff(np.sign(trigger - 1000))
+    crossings[crossings<0] = 0
+    crossings = np.where(crossings)[0]
+
+    window = int(370 / dt)
+    skip = 0
+
+    mon_peaks = []
+    rec_peaks = []
+    for ic in crossings:
+        if len(chanb[ic+skip:ic+window])==0:
+            continue
+        if peak:
+            mon_peaks.append(-1*np.min(chanb[ic+skip:ic+window]) + np.mean(chanb[ic+window-10:ic+window]))
+            rec_peaks.append(-1*np.min(chand[ic+skip:ic+window]) + np.mean(chand[ic+window-10:ic+window]) )
+        else:
+            mon_peaks.append(np.sum(chanb[ic+skip:ic+window])/window - np.sum(chanb[ic+window-10:ic+window]/10) )
+            rec_peaks.append(np.sum(chand[ic+skip:ic+window])/window - np.sum(chand[ic:ic+10])/10)
+    return mon_peaks, rec_peaks
+
+def fake_block(samples, dt, rng, period=370):
+    """
+        A sync pulse on `trigger` every `period` samples, and waveforms with noise and a pulse after about half of them on the others
+        The last flash leaves room for a whole window, so both versions see the same triggers. Returns raw ADC counts
+    """
+    trigger = np.zeros(samples)
+    flashes = np.arange(5, samples - 2*period, period)
+    for offset in range(5):
+        trigger[flashes+offset] = 1500.
+
+    channels = []
+    for delay in (7, 29):
+        signal = rng.normal(0, 0.5, samples)
+        fired = flashes[rng.random(len(flashes))<0.5]
+        heights = rng.exponential(40., len(fired))
+        signal[fired+delay] -= heights
+        signal[fired+delay+1] -= 0.5*heights
+        channels.append(signal)
+    return [np.clip(np.round(mV2adc(data, rang, MAX_ADC)), -MAX_ADC.value, MAX_ADC.value).astype(np.int16) for data, rang in zip((trigger, *channels), RANGES)]
+
+def converted_loop_peaks(trigger, chanb, chand, dt, peak=True):
+    """
+        The old calibrate from the ADC buffers: measure() converted all three channels to mV first
+    """
+    waves = [adc2mV(data, rang, MAX_ADC) for data, rang in zip((trigger, chanb, chand), RANGES)]
+    return loop_peaks(*waves, dt, peak)
+
+def new_peaks(trigger, chanb, chand, dt, peak=True):
+    """
+        What PicoMeasure.calibrate does now
+    """
+    scales = [channelInputRanges[rang]/MAX_ADC.value for rang in RANGES[1:]]
+    return calibration_peaks(trigger, chanb, chand, dt, peak, mV2adc(1000, RANGES[0], MAX_ADC), scales)
+
+def same_histograms(old, new, bins, rounding=1e-9):
+    """
+        Whether the histograms agree. The new values are exact and the old ones carry rounding, so a value sitting right on a bin edge
+        can land either side of it. Those are allowed for, and counted
+    """
+    old = np.asarray(old)
+    if len(old)!=len(new) or np.max(np.abs(old - new), initial=0)>rounding:
+        return False, 0
+    on_edge = np.min(np.abs(new[:, None] - bins[None, :]), axis=1)<=rounding
+    return np.array_equal(np.histogram(old[~on_edge], bins)[0], np.histogram(new[~on_edge], bins)[0]), int(np.count_nonzero(on_edge))
+
+def best_time(function, data, dt, peak, repeats):
+    """
+        The result, and the best time out of `repeats` runs
+    """
+    best = None
+    for _ in range(int(repeats)):
+        start = time.perf_counter()
+        result = function(*data, dt, peak)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def main(samples=37_000_000, dt=4., repeats=3, target=50.):
+    rng = np.random.default_rng(1)
+    raw = fake_block(int(samples), dt, rng)
+    waves = [adc2mV(data, rang, MAX_ADC) for data, rang in zip(raw, RANGES)]
+
+    ok = True
+    for peak, bins in ((True, np.linspace(0, 200, 129)), (False, np.linspace(-20, 20, 129))):
+        old, loop_time = best_time(loop_peaks, waves, dt, peak, repeats)
+        _, calibrate_time = best_time(converted_loop_peaks, raw, dt, peak, repeats)
+        new, new_time = best_time(new_peaks, raw, dt, peak, repeats)
+
+        checks = [same_histograms(before, after, bins) for before, after in zip(old, new)]
+        same = all(check[0] for check in checks)
+        edges = sum(check[1] for check in checks)
+        ok = ok and same and calibrate_time/new_time>=target
+        print("{:<6} {:>8} triggers  loop {:8.1f} ms ({:8.1f} ms from ADC)  vectorised {:6.1f} ms  "
+              "speedup {:5.1f} ({:5.1f} from ADC)  histograms {}{}".format(
+            "peak" if peak else "sum", len(old[0]), 1e3*loop_time, 1e3*calibrate_time, 1e3*new_time, loop_time/new_time, 
+            calibrate_time/new_time, "match" if same else "DIFFER", " ({} on a bin edge)".format(edges) if edges else ""))
+    return ok
+
+if __name__=="__main__":
+    sys.exit(0 if main(*[float(arg) for arg in sys.argv[1:]]) else 1)
@@ -0,0 +1,58 @@
+"""
+    Times the coincidence counting: the old per-window digitize passes against the single sorted merge
+
+    Run from the top of the repo with 
+        python -m benchmarks.coincidence
+"""
+import time
+
+import numpy as np
+
+from wms_midas.utilities.utils import coincidences, COUNT_WINDOWS
+
+def digitize_counts(trigs, channels, windows, dt):
+    """
+        What get_valid used to do: digitize the hits against the triggers again for every window
+    """
+    counts = np.zeros((len(channels), len(windows)), dtype=int)
+    for i, hits in enumerate(channels):
+        for j, (offset, width) in enumerate(windows):
+            hit_trig_time = (hits - trigs[np.digitize(hits, trigs)-1])*dt
+            counts[i][j] = np.sum(np.logical_and(hit_trig_time>offset, hit_trig_time<offset+width))
+    return counts
+
+def fake_block(samples, trig_period, efficiency, dark_rate, dt, rng):
+    """
+        Trigger and hit indices like in one capture: a trigger every `trig_period` samples, 
+        a prompt hit on each channel for `efficiency` of them, plus uniform dark hits at `dark_rate` per sample
+    """
+    trigs = np.arange(rng.integers(trig_period), samples, trig_period)
+    channels = []
+    for offset, _ in COUNT_WINDOWS[:2]:
+        fired = trigs[rng.random(len(trigs))<efficiency]
+        # land in the middle of the window, give or take a couple samples
+        prompt = fired + int((offset+12)/dt) + rng.integers(-2, 3, len(fired))
+        dark = rng.integers(0, samples, rng.poisson(dark_rate*samples))
+        channels.append(np.unique(np.concatenate((prompt, dark))))
+    return trigs, channels
+
+def main(samples=37_500_000, dt=4., repeats=5):
+    rng = np.random.default_rng(1)
+    print("{:>12} {:>10} {:>12} {:>12} {:>8}".format("trigs", "hits", "digitize [ms]", "merge [ms]", "speedup"))
+    for trig_period in (10000, 1000, 250):
+        trigs, channels = fake_block(samples, trig_period, 0.3, 1e-4, dt, rng)
+
+        times = []
+        for function in (digitize_counts, coincidences):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                counts = function(trigs, channels, COUNT_WINDOWS, dt)
+            times.append((time.perf_counter() - start)/repeats)
+            if function is digitize_counts:
+                reference = counts
+        assert np.array_equal(reference, counts), "counts differ"
+
+        print("{:>12} {:>10} {:>12.1f} {:>12.1f} {:>8.1f}".format(len(trigs), sum(len(hits) for hits in channels), 1e3*times[0], 1e3*times[1], times[0]/times[1]))
+
+if __name__=="__main__":
+    main()
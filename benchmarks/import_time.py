@@ -0,0 +1,57 @@
+"""
+    Cold-start import times for what each of the non-PicoScope frontends pulls in from wms_midas.utilities 
+    Each import runs in a fresh interpreter. Fails if any of them goes over the target, or drags in the PicoScope stack 
+
+    Run from the top of the repo with 
+        python -m benchmarks.import_time [target in seconds]
+"""
+import subprocess
+import sys
+
+# what feLEDBoard, feHVBox, and feStage import from us 
+IMPORTS = {
+    "feLEDBoard":"from wms_midas.utilities import LEDBoard",
+    "feHVBox":"from wms_midas.utilities import CAENBox, Status",
+    "feStage":"from wms_midas.utilities import ELLxConnection",
+}
+# none of these should be imported by the above 
+HEAVY = ["picosdk", "h5py", "matplotlib", "scipy", "StageControl"]
+
+CHILD = """
+import sys, time
+start = time.perf_counter()
+{}
+print(time.perf_counter() - start)
+print(",".join(name for name in {!r} if name in sys.modules))
+"""
+
+def time_import(statement, repeats=5):
+    """
+        Best time out of `repeats`, and the heavy modules it pulled in
+        Returns None for the time if the import fails, along with the last line of the error
+    """
+    best = None
+    for _ in range(repeats):
+        child = subprocess.run([sys.executable, "-c", CHILD.format(statement, HEAVY)], capture_output=True, text=True)
+        if child.returncode!=0:
+            return None, child.stderr.strip().split("\n")[-1]
+        out = child.stdout.split("\n")
+        elapsed = float(out[0])
+        best = elapsed if best is None else min(best, elapsed)
+    return best, [name for name in out[1].split(",") if name]
+
+def main(target=0.5):
+    ok = True
+    for frontend, statement in IMPORTS.items():
+        elapsed, heavy = time_import(statement)
+        if elapsed is None:
+            ok = False
+            print("{:<12} {:>8}     FAIL  ({})".format(frontend, "-", heavy))
+            continue
+        passed = elapsed<target and not heavy
+        ok = ok and passed
+        print("{:<12} {:8.1f} ms  {}{}".format(frontend, 1e3*elapsed, "ok" if passed else "FAIL", "  (imported {})".format(", ".join(heavy)) if heavy else ""))
+    return ok
+
+if __name__=="__main__":
+    sys.exit(0 if main(*[float(arg) for arg in sys.argv[1:]]) else 1)
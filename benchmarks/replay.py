@@ -0,0 +1,47 @@
+"""
+    Runs PicoMeasure's acquisition and analysis against a made-up LED pulse train (replay.PoissonSource), no scope needed
+    Prints the counts, how long each stage takes per block, and the live fraction, for each of the acquisition modes
+    The samples are made up as they're fetched, so "transfer" and "stream" are mostly the source's time, not the driver's
+
+    Run from the top of the repo with
+        python -m benchmarks.replay [seconds per mode] [block samples]
+"""
+import sys
+
+from wms_midas.utilities.read_pico import PicoMeasure
+from wms_midas.utilities.replay import ReplayDriver, PoissonSource
+
+# (name, PicoMeasure args, attributes to set)
+MODES = [
+    ("block", (True,), {}),
+    ("pipelined", (True,), {"pipelined":True}),
+    ("segmented", (True, True), {}),
+    ("stream", (False,), {}),
+    ("continuous", (False,), {"continuous":True}),
+]
+
+def run(name, args, attributes, seconds, block_samples):
+    pico = PicoMeasure(*args, backend=ReplayDriver(PoissonSource(mon_mu=1., rec_mu=0.2, seed=0)))
+    if args[0] and not pico.segmented:
+        pico.block_samples = block_samples
+        pico._configure_capture()
+    for key, value in attributes.items():
+        setattr(pico, key, value)
+    pico.collection_time = seconds
+    pico.enable_timing()
+
+    trig, mon, rec, mond, recd, live, dead = pico.measure()
+    summary = pico.timing_summary()
+    pico.close()
+
+    print("{:<11} trig {:>9}  mon {:>9}  rec {:>9}  dark {:>5} {:>5}  live fraction {:.3f}".format(name, trig, mon, rec, mond, recd, live/(live+dead)))
+    for stage, entry in summary["stages"].items():
+        if entry["mean"]>0:
+            print("    {:<13} p50 {:8.2f} ms  p99 {:8.2f} ms  {:5.1f}%".format(stage, 1e3*entry["p50"], 1e3*entry["p99"], 100*entry["fraction"]))
+
+def main(seconds=2., block_samples=370*20000):
+    for name, args, attributes in MODES:
+        run(name, args, attributes, seconds, int(block_samples))
+
+if __name__=="__main__":
+    main(*[float(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,101 @@
+"""
+    What enable_timing costs: pipelined block acquisition on the replay driver, with and without the StageTimer
+
+    Two numbers come out. The end-to-end one runs the replay both ways, alternating, and compares the samples analysed per second.
+    That's the honest one, but it's only good to the run-to-run noise (a percent or two on a busy machine).
+    The other counts the timer calls a block makes, and times those calls on their own. That's the overhead without the noise,
+    and it has to come in under `limit` percent of the time per block. The default block is the smallest autotune tries,
+    where the timer's share is biggest
+
+    Run from the top of the repo with
+        python -m benchmarks.timing_overhead [seconds per run] [block samples] [runs] [limit %]
+"""
+import sys
+import time
+
+import numpy as np
+
+from wms_midas.utilities.read_pico import PicoMeasure, TIMED_STAGES
+from wms_midas.utilities.replay import ReplayDriver, PoissonSource
+from wms_midas.utilities.timing import StageTimer
+
+class CountingTimer(StageTimer):
+    """
+        A StageTimer that also counts how often it's used
+    """
+    def __init__(self, stages, size=1024):
+        super().__init__(stages, size)
+        self.adds = 0
+        self.ends = 0
+
+    def add(self, stage, seconds):
+        self.adds += 1
+        super().add(stage, seconds)
+
+    def end_block(self, live):
+        self.ends += 1
+        super().end_block(live)
+
+def replay(seconds, block_samples, timer=None):
+    """
+        Triggers counted per second of wall-clock time, and the seconds per block, with `timer` (or no timing)
+    """
+    pico = PicoMeasure(True, backend=ReplayDriver(PoissonSource(mon_mu=1., rec_mu=0.2, seed=0)))
+    pico.block_samples = block_samples
+    pico._configure_capture()
+    pico.pipelined = True
+    pico.collection_time = seconds
+    if timer is not None:
+        pico.timer = timer
+
+    start = time.perf_counter()
+    trig = pico.measure()[0]
+    elapsed = time.perf_counter() - start
+    pico.close()
+    return trig/elapsed, elapsed/timer.ends if timer is not None else None
+
+def per_call(repeats=100_000):
+    """
+        Seconds per timed stage, and per end_block
+    """
+    timer = StageTimer(TIMED_STAGES)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        with timer.time("crossings"):
+            pass
+    stage = (time.perf_counter() - start)/repeats
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        timer.end_block(0.)
+    return stage, (time.perf_counter() - start)/repeats
+
+def main(seconds=3., block_samples=1_000_000, runs=4, limit=1.):
+    block_samples = int(block_samples)
+    # a short run first, so the imports and the source's noise bank aren't timed
+    replay(0.2, block_samples)
+
+    rates = {False:[], True:[]}
+    block_times = []
+    for _ in range(int(runs)):
+        # alternating, so drifts in the machine's speed hit both the same
+        for timed in (False, True):
+            timer = CountingTimer(TIMED_STAGES) if timed else None
+            rate, block_time = replay(seconds, block_samples, timer)
+            rates[timed].append(rate)
+            if timed:
+                block_times.append(block_time)
+                calls = timer.adds/timer.ends
+    end_to_end = 100*(1 - np.median(rates[True])/np.median(rates[False]))
+    block_time = np.median(block_times)
+
+    stage, end = per_call()
+    direct = 100*(calls*stage + end)/block_time
+
+    print("pipelined blocks of {} samples: {:.1f} ms each".format(block_samples, 1e3*block_time))
+    print("timer calls per block: {:.1f} stages at {:.2f} us, and end_block at {:.2f} us".format(calls, 1e6*stage, 1e6*end))
+    print("overhead from the calls {:.4f}%, end to end {:+.2f}% (good to the run to run noise)".format(direct, end_to_end))
+    return direct<limit
+
+if __name__=="__main__":
+    sys.exit(0 if main(*[float(arg) for arg in sys.argv[1:]]) else 1)
@@ -0,0 +1,71 @@
+"""
+    Checks the counting on made-up captures from PoissonSource: chunked, pooled, and one-pass analyses have to agree
+    No scope needed. Run from the top of the repo with
+        python -m pytest -q tests
+"""
+import numpy as np
+import pytest
+
+from wms_midas.utilities.replay import ReplayDriver, PoissonSource, MAX_ADC
+from wms_midas.utilities.utils import CrossingFinder, StreamCounter, count_block
+from wms_midas.utilities.analysis_pool import AnalysisPool
+
+DT = 4.
+# full scales of A, B, D [mV], like PicoMeasure's defaults
+RANGES = (2000, 200, 200)
+TRIG_LEVEL = 1000*MAX_ADC/RANGES[0]
+MON_THRESH = 10*MAX_ADC/RANGES[1]
+REC_THRESH = 10*MAX_ADC/RANGES[2]
+
+@pytest.fixture(scope="module")
+def capture():
+    source = PoissonSource(mon_mu=1., rec_mu=0.3, dark_rate=1e5, seed=1)
+    source.configure(DT, RANGES, MAX_ADC)
+    return source.read(1<<21)
+
+def test_stream_counter_matches_count_block(capture):
+    whole = count_block(*capture, TRIG_LEVEL, MON_THRESH, REC_THRESH, DT)
+    assert whole[0]>1000 and all(entry>0 for entry in whole)
+
+    counter = StreamCounter(TRIG_LEVEL, MON_THRESH, REC_THRESH, DT)
+    # uneven chunks, so the edges land all over the place relative to the flashes
+    edges = np.unique(np.concatenate(([0, capture.shape[1]], np.random.default_rng(2).integers(0, capture.shape[1], 40))))
+    for start, stop in zip(edges[:-1], edges[1:]):
+        counter.add(*capture[:, start:stop])
+    assert tuple(counter.counts)==whole
+    assert counter.samples==capture.shape[1]
+
+def test_pool_matches_count_block(capture):
+    whole = count_block(*capture, TRIG_LEVEL, MON_THRESH, REC_THRESH, DT)
+    pool = AnalysisPool(workers=3)
+    try:
+        shared = [pool.share(channel) for channel in capture]
+        assert pool.count(*shared, TRIG_LEVEL, MON_THRESH, REC_THRESH, DT)==whole
+    finally:
+        del shared
+        pool.close()
+
+def naive_crossings(signal, level, negative=False, use_rise=False):
+    over = signal<level if negative else signal>level
+    step = np.diff(over.astype(int))
+    return np.flatnonzero(step==1 if use_rise else step==-1)
+
+@pytest.mark.parametrize("negative", (False, True))
+@pytest.mark.parametrize("use_rise", (False, True))
+def test_crossing_finder_matches_diff(capture, negative, use_rise):
+    # a small chunk, so plenty of crossings sit right on a chunk boundary
+    finder = CrossingFinder(997)
+    for signal, level in ((capture[0], int(TRIG_LEVEL)), (capture[1], -int(MON_THRESH)), (capture[1].astype(float), -MON_THRESH)):
+        found = finder.crossings(signal, level, negative, use_rise)
+        assert np.array_equal(found, naive_crossings(signal, level, negative, use_rise))
+
+        # split in two, with the sample before the second half carried over
+        half = len(signal)//2 + 3
+        second = finder.crossings(signal[half:], level, negative, use_rise, previous=signal[half-1])
+        assert np.array_equal(np.concatenate((finder.crossings(signal[:half], level, negative, use_rise), second + half)), found)
+
+def test_streaming_needs_ns():
+    driver = ReplayDriver(PoissonSource(seed=0))
+    units = driver.PS3000A_TIME_UNITS["PS3000A_US"]
+    with pytest.raises(ValueError):
+        driver.ps3000aRunStreaming(0, None, units, 0, 1000, 0, 1, 0, 1000)
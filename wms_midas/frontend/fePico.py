@@ -4,13 +4,15 @@ import midas.frontend
 import midas.event
 
 import collections
+import queue
+import threading
 
 from pexpect import pxssh 
 import numpy as np 
 import time 
 import ast 
 
-from wms_midas.utilities import HOST, USER, PASSWORD, PORT, KEY, PicoMeasure
+from wms_midas.utilities import HOST, USER, PASSWORD, PORT, KEY, PicoMeasure, PicoDaemon
 
 class PicoScope(midas.frontend.EquipmentBase):
     """
@@ -22,6 +24,7 @@ class PicoScope(midas.frontend.EquipmentBase):
     def __init__(self, client:midas.client.MidasClient):
         devName = "PicoScope"
         equip_name = "PicoScope"
+        self.equip_name = equip_name
     
         default_common = midas.frontend.InitialEquipmentCommon()
         default_common.equip_type = midas.EQ_POLLED
@@ -34,64 +37,214 @@ class PicoScope(midas.frontend.EquipmentBase):
 
         default_settings = collections.OrderedDict([  
             ("dev",devName),
-
+            # run the scope and the analysis in their own processes 
+            ("daemon", False),
+            # stop each measurement once the rec/mon ratio is known this well, rather than after a fixed time 
+            ("adaptive", False),
+            ("target precision", 0.01),
+            ("min collection time", 2.),
+            ("max collection time", 120.),
+            # how long [s] the stage/LED have to sit still before we measure 
+            ("settle time", 2.),
+            # pick the block size with the best live time at startup, within this many MB of buffers
+            ("autotune", False),
+            ("buffer budget MB", 1024),
+            # time each stage of the acquisition, and put the breakdown in Variables after every measurement
+            ("timing", False),
         ]) 
         self.client = client 
 
         midas.frontend.EquipmentBase.__init__(self, client, equip_name, default_common, default_settings)
 
-        self._waiting = False 
-        self._adc_updated = False 
-        self._led_updated = False 
-        self._stage_updated = False
-
-        self._picoscope = PicoMeasure(True)
+        # the stage position, LED ADC, and LED we're at, and when any of them last changed
+        self._config = {"stage":np.nan, "adc":-1, "led":-1}
+        self._changed = None
+        # bumped on every change, so a measurement that straddles one can be thrown out
+        self._generation = 0
+        self._running = False
+
+        if self.settings["daemon"]:
+            self._picoscope = PicoDaemon()
+            self._picoscope.start()
+        else:
+            self._picoscope = PicoMeasure(True)
+            self._picoscope.pipelined = True
+            self._picoscope.adaptive = self.settings["adaptive"]
+            self._picoscope.target_precision = self.settings["target precision"]
+            self._picoscope.min_collection_time = self.settings["min collection time"]
+            self._picoscope.max_collection_time = self.settings["max collection time"]
+            if self.settings["autotune"]:
+                size = self._picoscope.autotune(memory_budget=self.settings["buffer budget MB"]*(1<<20))
+                self.client.msg("PicoScope block size tuned to {} samples".format(size))
+            if self.settings["timing"]:
+                self._picoscope.enable_timing()
         self._picoscope.collection_time = 30 
 
+        # running totals from the measurement in progress, mirrored into the ODB from the midas thread
+        self._progress = queue.Queue()
+        if not self.settings["daemon"]:
+            self._picoscope.on_progress = self._progress.put
+
+        # measurements run on their own thread so the midas loop (ODB watches, run transitions) never waits on the scope 
+        self._requests = queue.Queue()
+        self._results = queue.Queue()
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+
+    def _work(self):
+        """
+            Worker thread. Measures each configuration that's requested, and queues up the results for readout_func 
+        """
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            config, generation = request
+            # clear the abort before looking at the generation. A change (or the end of the run) after this sets it again, 
+            # and one before it is caught by the check, so none can slip in between and go unnoticed
+            if hasattr(self._picoscope, "abort"):
+                self._picoscope.abort.clear()
+            if not self._running or generation!=self._generation:
+                continue
+            start = time.time()
+            try:
+                result = self._picoscope.measure()
+            except Exception as e:
+                # report it and wait for the next request, rather than losing the worker for the rest of the run
+                self.client.msg("PicoScope measurement failed: {}".format(e), True)
+                continue
+            # anything cut short by the end of the run, or by the stage/LED moving, gets dropped
+            if self._running and generation==self._generation:
+                self._results.put((config, start, time.time(), result, getattr(self._picoscope, "last_precision", np.inf)))
+
     def start_run(self):
-        pass 
-
-    def adc_updated(self):
-        pass 
-    def led_updated(self):
-        pass 
-    def stage_updated(self):
-        pass 
-    
+        while not self._results.empty():
+            self._results.get_nowait()
+        self._running = True
+        # measure wherever we are now, then again each time something moves
+        self._requests.put((dict(self._config), self._generation))
+
+    def stop_run(self):
+        self._running = False
+        while not self._requests.empty():
+            self._requests.get_nowait()
+        if hasattr(self._picoscope, "abort"):
+            self._picoscope.abort.set()
+
+    def close(self):
+        self.stop_run()
+        self._requests.put(None)
+        self._worker.join()
+        self._picoscope.close()
+
+    def check_readout(self, key, value):
+        """
+            Called when the stage or LED board reports a new `key` (stage, adc, led). We measure once things have settled 
+        """
+        if self._config[key]!=value:
+            self._config[key] = value
+            self._changed = time.time()
+            self._generation += 1
+            # whatever's being measured now isn't where we are anymore
+            if hasattr(self._picoscope, "abort"):
+                self._picoscope.abort.set()
+
+    def publish_progress(self):
+        """
+            Put the latest running totals from the measurement into the ODB 
+        """
+        latest = None
+        while True:
+            try:
+                latest = self._progress.get_nowait()
+            except queue.Empty:
+                break
+        if latest is None:
+            return
+
+        variables = "/Equipment/{}/Variables/".format(self.equip_name)
+        self.client.odb_set(variables+"running_counts", [latest["trig"], latest["mon"], latest["rec"], latest["mon_dark"], latest["rec_dark"]], True)
+        self.client.odb_set(variables+"running_rates", [latest["trig_rate"], latest["mon_rate"], latest["rec_rate"]], True)
+        self.client.odb_set(variables+"running_precision", min(latest["precision"], 1e9), True)
+        self.client.odb_set(variables+"running_elapsed", latest["elapsed"], True)
+        self.client.odb_set(variables+"saturated", latest["saturated"], True)
+
+    def publish_timing(self):
+        """
+            Put the time spent in each stage of the acquisition into the ODB, if we're timing it
+        """
+        summary = self._picoscope.timing_summary() if hasattr(self._picoscope, "timing_summary") else None
+        if summary is None or summary["blocks"]==0:
+            return
+
+        variables = "/Equipment/{}/Variables/".format(self.equip_name)
+        stages = list(summary["stages"])
+        self.client.odb_set(variables+"timing_stages", stages, True)
+        self.client.odb_set(variables+"timing_p50_ms", [1e3*summary["stages"][stage]["p50"] for stage in stages], True)
+        self.client.odb_set(variables+"timing_p99_ms", [1e3*summary["stages"][stage]["p99"] for stage in stages], True)
+        self.client.odb_set(variables+"timing_fraction", [summary["stages"][stage]["fraction"] for stage in stages], True)
+        self.client.odb_set(variables+"live_fraction", summary["live_fraction"], True)
+
     def poll_func(self):
         """
-            Check if we're ready to make a measurement 
+            Ask for a measurement once the configuration has settled. There's an event to send if one has finished 
         """
-        return self._adc_updated and self._led_updated and self._stage_updated 
+        self.publish_progress()
+        if self._changed is not None and (time.time() - self._changed)>=self.settings["settle time"]:
+            self._changed = None
+            if self._running:
+                self._requests.put((dict(self._config), self._generation))
+        return not self._results.empty()
 
     def readout_func(self):
-        self._waiting = True 
-        self._adc_updated = False 
-        self._led_updated = False 
-        self._stage_updated = False
-
-        # make measurement... 
-
-        # set new target and start waiting again 
+        """
+            Send out the next finished measurement 
+        """
+        try:
+            config, start, end, result, precision = self._results.get_nowait()
+        except queue.Empty:
+            return None
+        trig, mon, rec, mond, recd, live, dead = result
+        self.publish_timing()
+
+        event = midas.event.Event()
+        event.create_bank("CNTS", midas.TID_INT, [int(trig), int(mon), int(rec)])
+        event.create_bank("DARK", midas.TID_INT, [int(mond), int(recd)])
+        event.create_bank("TIME", midas.TID_DOUBLE, [start, end, float(live), float(dead)])
+        event.create_bank("CONF", midas.TID_DOUBLE, [float(config["stage"]), float(config["adc"]), float(config["led"]), min(float(precision), 1e9)])
+        return event
 
 class fePicoScope(midas.frontend.FrontendBase):
+    # where the stage and LED frontends report what they're set to, and the key check_readout knows each one by
+    watched = {
+        "/Equipment/ELLXStage/Variables/dest":"stage",
+        "/Equipment/LEDBoard/Variables/ADC":"adc",
+        "/Equipment/LEDBoard/Variables/LED":"led",
+    }
+
     def __init__(self, picoscope:PicoScope):
         midas.frontend.FrontendBase.__init__(self, "feButtonManager")
         self.pico = picoscope(self.client)
         self.add_equipment(self.pico)
 
         # these can be changed by the user 
-        self.client.odb_watch("/Equipment/ELLxStage/Variables/destination",self.check_readout)
-        self.client.odb_watch("/Equipment/LEDBoard/Variables/adc",self.check_readout)
-        self.client.odb_watch("/Equipment/LEDBoard/Variables/LED",self.check_readout)        
+        for path in self.watched:
+            self.client.odb_watch(path, self.check_readout)
+
+    def check_readout(self, client, path, odb_value):
+        self.pico.check_readout(self.watched[path], odb_value)
 
     def begin_of_run(self, run_number):
         self.set_all_equipment_status("Running", "greenLight")
         self.client.msg("Frontend has seen start of run number %d" % run_number)
+        self.pico.start_run()
         return midas.status_codes["SUCCESS"]
         
     def end_of_run(self, run_number):
+        self.pico.stop_run()
         self.set_all_equipment_status("Finished", "greenLight")
         self.client.msg("Frontend has seen end of run number %d" % run_number)
         return midas.status_codes["SUCCESS"]
 
+    def frontend_exit(self):
+        self.pico.close()
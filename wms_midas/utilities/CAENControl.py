@@ -1,7 +1,7 @@
 import serial 
 import time 
 from contextlib import ContextDecorator
-from StageControl.utils import LEDNotFound
+from wms_midas.utilities.LEDControl import LEDNotFound
 import os 
 from enum import Enum, Flag, auto
 
@@ -1,7 +1,33 @@
-from wms_midas.utilities.ELLxControl import ELLxConnection, Status
-from wms_midas.utilities.LEDControl import LEDBoard, LEDNotFound
+"""
+    The equipment classes are only imported when they're first used. 
+    So a frontend that only needs the LED board doesn't have to import (or even have) the PicoScope stack 
+"""
+import importlib
 
 from wms_midas.utilities.constants import *
-from wms_midas.utilities.read_pico import PicoMeasure
-from wms_midas.utilities.ELLxControl import ELLxConnection
-from wms_midas.utilities.CAENControl import CAENBox, Status
\ No newline at end of file
+
+# public name -> module it lives in
+_exports = {
+    "ELLxConnection":"ELLxControl",
+    "LEDBoard":"LEDControl",
+    "LEDNotFound":"LEDControl",
+    "PicoMeasure":"read_pico",
+    "PicoDaemon":"pico_daemon",
+    "Scan":"scan",
+    "PulseRecordWriter":"storage",
+    "SnapshotWriter":"storage",
+    "ReplayDriver":"replay",
+    "CAENBox":"CAENControl",
+    # the CAEN one, not the ELLx one 
+    "Status":"CAENControl",
+}
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module("wms_midas.utilities."+_exports[name]), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_exports.keys()))
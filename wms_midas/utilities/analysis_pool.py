@@ -0,0 +1,155 @@
+"""
+    Splits the analysis of one capture across a pool of processes
+
+    The capture buffers live in shared memory, so the workers read them directly without any copies.
+    Each worker takes one stretch of the capture, and looks back far enough before it to see any trigger
+    that a hit in its stretch could be matched to. So the counts from all the workers add up to exactly
+    what a single pass over the whole capture would give.
+"""
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from wms_midas.utilities.utils import get_crossing_finder, get_level, coincidences, COUNT_WINDOWS
+
+# past the end of the latest coincidence window (shifted receiver window: 104+150+24 ns)
+LOOKBACK_NS = 300
+
+# shared memory blocks this worker has already attached to
+_attached = {}
+
+def _attach(name, length, dtype):
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray((length,), dtype=dtype, buffer=_attached[name].buf)
+
+def _forget(retired):
+    """
+        Let go of the blocks the pool has since unlinked, our mapping is all that's keeping them around
+    """
+    for name in retired:
+        if name in _attached:
+            _attached.pop(name).close()
+
+def _pedestal_part(names, length, dtype, start, stop, peds, windows, retired=()):
+    """
+        Sum and count of the near-pedestal samples on the monitor and receiver, for one stretch
+    """
+    _forget(retired)
+    finder = get_crossing_finder()
+    sums = []
+    for name, ped, window in zip(names, peds, windows):
+        signal = _attach(name, length, dtype)
+        sums.append(finder.pedestal_sums(signal[start:stop], ped, window))
+    return sums
+
+def _count_part(names, length, dtype, start, stop, lookback, trig_level, levels, dt, retired=()):
+    """
+        Counts the triggers and hits in [start, stop)
+
+        Triggers are found from `lookback` samples before the start, so hits at the start can be matched to them.
+        We read one sample past the stop so the crossings right at the end are caught
+    """
+    _forget(retired)
+    finder = get_crossing_finder()
+    chana, chanb, chand = [_attach(name, length, dtype) for name in names]
+
+    first = max(start - lookback, 0)
+    trigs = finder.crossings(chana[first:stop+1], trig_level, False, True) + first
+    ntrig = np.count_nonzero(trigs>=start)
+
+    hits = [finder.crossings(chan[start:stop+1], levels[i], True, False) + start for i, chan in enumerate((chanb, chand))]
+    counts = coincidences(trigs, hits, COUNT_WINDOWS, dt)
+
+    return np.array([ntrig, counts[0][0], counts[1][1], counts[0][2], counts[1][3]], dtype=int)
+
+class AnalysisPool:
+    """
+        A pool of analysis processes, and the shared memory they read the capture buffers from
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        # spawn, since we're usually submitting from a thread
+        self._executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        self._shared = {}
+        # the block (and its address) shared under each key, and the names of the ones since unlinked
+        self._keys = {}
+        self._retired = []
+
+    def share(self, buffer:np.ndarray, key=None)->np.ndarray:
+        """
+            Returns a copy of `buffer` that lives in shared memory. Captures into it can then be analysed by the pool
+
+            Sharing under a `key` that's been used before replaces that buffer. Its block is reused if it's the right size,
+            otherwise it's unlinked, so laying the capture out again (like `autotune` does for every size) doesn't pile up shared memory
+        """
+        shm = None
+        if key in self._keys:
+            address, old = self._keys.pop(key)
+            if old.size==buffer.nbytes:
+                shm = self._shared.pop(address)
+            else:
+                self._release(address)
+        if shm is None:
+            shm = shared_memory.SharedMemory(create=True, size=buffer.nbytes)
+        shared = np.ndarray(buffer.shape, dtype=buffer.dtype, buffer=shm.buf)
+        shared[:] = buffer
+        self._shared[shared.ctypes.data] = shm
+        if key is not None:
+            self._keys[key] = (shared.ctypes.data, shm)
+        return shared
+
+    def _release(self, address):
+        shm = self._shared.pop(address)
+        try:
+            shm.close()
+        except BufferError:
+            # something still has a view of it. The memory goes once that does
+            pass
+        shm.unlink()
+        self._retired.append(shm.name)
+
+    def _name(self, buffer):
+        if buffer.ctypes.data not in self._shared:
+            raise ValueError("Buffer isn't in shared memory; make it with AnalysisPool.share")
+        return self._shared[buffer.ctypes.data].name
+
+    def count(self, bufferA, bufferB, bufferD, trig_level, mon_thresh, rec_thresh, dt, mon_ped=0, rec_ped=0):
+        """
+            Same counts as PicoMeasure._analyse_block: triggers, monitor, receiver, monitor dark, receiver dark
+            The thresholds are in the same units (ADC counts) as the buffers
+        """
+        names = [self._name(buffer) for buffer in (bufferA, bufferB, bufferD)]
+        length = len(bufferA)
+        dtype = bufferA.dtype.str
+        edges = np.linspace(0, length, self.workers+1).astype(int)
+
+        # first pass for the pedestals, they're needed before any of the hits can be found
+        peds = [mon_ped, rec_ped]
+        windows = [0.66*mon_thresh, 0.66*rec_thresh]
+        jobs = [self._executor.submit(_pedestal_part, names[1:], length, dtype, edges[i], edges[i+1], peds, windows, tuple(self._retired)) for i in range(self.workers)]
+        totals = np.zeros((2,2))
+        for job in jobs:
+            totals += job.result()
+        for i in range(2):
+            if totals[i][1]!=0:
+                peds[i] = totals[i][0]/totals[i][1]
+
+        levels = [get_level(peds[0], mon_thresh, True, bufferB.dtype), get_level(peds[1], rec_thresh, True, bufferD.dtype)]
+        trig_level = get_level(0, trig_level, False, bufferA.dtype)
+        lookback = int(np.ceil(LOOKBACK_NS/dt))+1
+
+        jobs = [self._executor.submit(_count_part, names, length, dtype, edges[i], edges[i+1], lookback, trig_level, levels, dt, tuple(self._retired)) for i in range(self.workers)]
+        counts = np.zeros(5, dtype=int)
+        for job in jobs:
+            counts += job.result()
+        return tuple(int(entry) for entry in counts)
+
+    def close(self):
+        self._executor.shutdown()
+        for address in list(self._shared):
+            self._release(address)
+        self._keys = {}
+        self._retired = []
@@ -0,0 +1,29 @@
+"""
+    Stand-ins for modules that are slow to import, or that only the PicoScope code needs
+    The real import happens the first time an attribute is looked up, so just importing our modules stays cheap
+"""
+import importlib
+
+class LazyModule:
+    """
+        Imports `name` the first time one of its attributes is used. If `attribute` is given, stands in for that attribute of the module instead
+            ps = LazyModule("picosdk.ps3000a", "ps3000a")  # like `from picosdk.ps3000a import ps3000a as ps`
+    """
+    def __init__(self, name, attribute=None):
+        self._name = name
+        self._attribute = attribute
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            target = importlib.import_module(self._name)
+            if self._attribute is not None:
+                target = getattr(target, self._attribute)
+            self._target = target
+        return self._target
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return "<lazy {}>".format(self._name if self._attribute is None else self._name+"."+self._attribute)
@@ -0,0 +1,200 @@
+"""
+    Runs the PicoScope acquisition and the analysis in two separate processes
+
+    The acquisition process only talks to the ps3000a driver. It pulls each block straight into a free slot
+    of a shared-memory ring, and moves on to the next capture. The analysis process reads the filled slots,
+    counts the hits, and sends the totals for each measurement back to whoever asked for it (the fePico frontend).
+    So a slow analysis, the garbage collector, or a busy midas client can't hold up the driver calls.
+
+    If the analysis falls behind and every slot is full, the acquisition either waits for one (back-pressure)
+    or drops the block. Both are counted in the ring's header.
+"""
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import time
+
+import numpy as np
+
+from wms_midas.utilities.utils import count_block
+
+# counters at the start of the ring
+WRITTEN = 0
+CONSUMED = 1
+DROPPED = 2
+STALLS = 3
+N_COUNTERS = 4
+
+# per-slot metadata: tag, last, trig level, mon thresh, rec thresh, mon ped, rec ped, dt [ns], live [s], elapsed [s]
+N_META = 10
+
+class SlotRing:
+    """
+        A fixed number of slots in shared memory. Each one holds a raw three-channel (A, B, D) capture, plus what's needed to analyse it
+        Pass the `name` to attach to an existing ring
+    """
+    def __init__(self, n_slots, slot_samples, name=None):
+        self.n_slots = n_slots
+        self.slot_samples = slot_samples
+
+        meta_offset = N_COUNTERS*8
+        data_offset = meta_offset + n_slots*N_META*8
+        size = data_offset + n_slots*3*slot_samples*2
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+
+        self.counters = np.ndarray((N_COUNTERS,), dtype=np.int64, buffer=self._shm.buf)
+        self.meta = np.ndarray((n_slots, N_META), dtype=np.float64, buffer=self._shm.buf, offset=meta_offset)
+        self.data = np.ndarray((n_slots, 3, slot_samples), dtype=np.int16, buffer=self._shm.buf, offset=data_offset)
+        if name is None:
+            self.counters[:] = 0
+
+    def close(self, unlink=False):
+        # these all hold views of the shared memory
+        del self.counters, self.meta, self.data
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+
+def _acquire(n_slots, free, filled, commands, status, back_pressure):
+    """
+        Acquisition process. Waits for ("measure", tag, seconds) commands until it gets ("stop",)
+    """
+    from wms_midas.utilities.read_pico import PicoMeasure
+
+    pico = PicoMeasure(True)
+    ring = SlotRing(n_slots, pico.totalSamples)
+    status.put((ring.name, pico.totalSamples))
+
+    write = 0
+    while True:
+        command = commands.get()
+        if command[0]=="stop":
+            break
+        _, tag, seconds = command
+
+        start = time.time()
+        while True:
+            pico._arm_block()
+            pico._wait_block()
+            last = (time.time() - start)>=seconds
+
+            # never drop the last block of a measurement, it's what tells the analysis that the measurement is over
+            if last or back_pressure:
+                if not free.acquire(False):
+                    ring.counters[STALLS] += 1
+                    free.acquire()
+            elif not free.acquire(False):
+                ring.counters[DROPPED] += 1
+                continue
+
+            slot = write%n_slots
+            maxADC = pico._fetch_block(*ring.data[slot])
+            ring.meta[slot] = [tag, last, *pico._adc_levels(maxADC), pico.actualSampleIntervalNs, pico._block_live_time(), time.time()-start]
+            ring.counters[WRITTEN] += 1
+            write += 1
+            filled.release()
+            if last:
+                break
+
+    pico.close()
+    ring.close()
+
+def _analyse(ring_name, n_slots, slot_samples, free, filled, results, stop):
+    """
+        Analysis process. Sums up the counts for each measurement, and sends them out once its last block is in
+    """
+    ring = SlotRing(n_slots, slot_samples, ring_name)
+    totals = {}
+
+    read = 0
+    while not stop.is_set():
+        if not filled.acquire(timeout=0.5):
+            continue
+        slot = read%n_slots
+        tag, last, trig_level, mon_thresh, rec_thresh, mon_ped, rec_ped, dt, live, elapsed = ring.meta[slot]
+        counts = count_block(*ring.data[slot], trig_level, mon_thresh, rec_thresh, dt, mon_ped, rec_ped)
+        ring.counters[CONSUMED] += 1
+        read += 1
+        free.release()
+
+        if tag not in totals:
+            totals[tag] = [np.zeros(5, dtype=int), 0.]
+        totals[tag][0] += counts
+        totals[tag][1] += live
+        if last:
+            counts, live = totals.pop(tag)
+            results.put((int(tag), *[int(entry) for entry in counts], float(live), float(elapsed-live)))
+
+    ring.close()
+
+class PicoDaemon:
+    """
+        Stands in for a block-mode PicoMeasure, but with the acquisition and analysis each in their own process
+        `measure` returns the same tuple as PicoMeasure.measure
+    """
+    def __init__(self, n_slots=4, back_pressure=True):
+        self.collection_time = 30
+        self.n_slots = n_slots
+        self.back_pressure = back_pressure
+
+        self._ctx = multiprocessing.get_context("spawn")
+        self._free = self._ctx.Semaphore(n_slots)
+        self._filled = self._ctx.Semaphore(0)
+        self._commands = self._ctx.Queue()
+        self._results = self._ctx.Queue()
+        self._stop = self._ctx.Event()
+        self._tag = 0
+        self._ring = None
+
+    def start(self, timeout=60):
+        status = self._ctx.Queue()
+        self._acquisition = self._ctx.Process(target=_acquire, args=(self.n_slots, self._free, self._filled, self._commands, status, self.back_pressure), daemon=True)
+        self._acquisition.start()
+        try:
+            ring_name, slot_samples = status.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("Acquisition process didn't start after {} s".format(timeout))
+
+        self._ring = SlotRing(self.n_slots, slot_samples, ring_name)
+        self._analysis = self._ctx.Process(target=_analyse, args=(ring_name, self.n_slots, slot_samples, self._free, self._filled, self._results, self._stop), daemon=True)
+        self._analysis.start()
+
+    def measure(self, poll=1.):
+        """
+            Waits on the result, checking every `poll` seconds that both processes are still up
+            Raises RuntimeError if one of them has died, rather than waiting forever
+        """
+        self._tag += 1
+        self._commands.put(("measure", self._tag, self.collection_time))
+        while True:
+            try:
+                result = self._results.get(timeout=poll)
+            except queue.Empty:
+                for name, process in (("Acquisition", self._acquisition), ("Analysis", self._analysis)):
+                    if not process.is_alive():
+                        raise RuntimeError("{} process died (exit code {}) during measurement {}".format(name, process.exitcode, self._tag))
+                continue
+            if result[0]==self._tag:
+                return result[1:]
+
+    def counters(self):
+        """
+            Blocks written to the ring, analysed, dropped, and how many times the acquisition had to wait on a slot
+        """
+        return {
+            "written":int(self._ring.counters[WRITTEN]),
+            "consumed":int(self._ring.counters[CONSUMED]),
+            "dropped":int(self._ring.counters[DROPPED]),
+            "stalls":int(self._ring.counters[STALLS]),
+        }
+
+    def close(self):
+        self._commands.put(("stop",))
+        self._acquisition.join()
+        self._stop.set()
+        self._analysis.join()
+        self._ring.close(unlink=True)
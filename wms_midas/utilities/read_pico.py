@@ -3,18 +3,23 @@
 import os 
 import ctypes
 import numpy as np
-import h5py as h5 
-from picosdk.ps3000a import ps3000a as ps
-import matplotlib.pyplot as plt
-from picosdk.functions import adc2mV, assert_pico_ok, PICO_STATUS_LOOKUP
 import time
-from scipy.signal import find_peaks
-from StageControl.picocode.utils import get_valid, get_cfd_time, count_hits
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, Future
+from wms_midas.utilities.utils import ps, assert_pico_ok, get_cfd_time, count_block, count_coincident, StreamCounter, CrossingFinder, get_crossing_finder, get_level, pulse_amplitudes, threshold_counts, pulse_records, COUNT_WINDOWS, SEARCH_WINDOW, FLAG_SATURATED, BlockReady, TimingHistogram, BufferArena
+from wms_midas.utilities.analysis_pool import AnalysisPool
 import json 
-from picosdk.PicoDeviceEnums import picoEnum
+from wms_midas.utilities.lazy import LazyModule
+from wms_midas.utilities.timing import NULL_TIMER, StageTimer
+
+picoEnum = LazyModule("picosdk.PicoDeviceEnums", "picoEnum")
 
 thresh = 10
 
+# what `PicoMeasure.enable_timing` keeps track of, per block 
+TIMED_STAGES = ("arm", "wait", "transfer", "convert", "crossings", "coincidence", "pool", "stream", "stream_count")
+
 
 channelInputRanges = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000]
 def adc2mV(buffer, rang, maxADC):
@@ -24,6 +29,12 @@ def adc2mV(buffer, rang, maxADC):
     """
     return (buffer.astype(float)*channelInputRanges[rang])/maxADC.value 
 
+def mV2adc(value, rang, maxADC):
+    """
+        The other direction. Used to move thresholds into ADC counts, rather than moving waveforms into mV
+    """
+    return value*maxADC.value/channelInputRanges[rang]
+
 def fold_min(thisdat, nmerge=370):
     if nmerge==1:
         raise NotImplementedError("This is nonsense")
@@ -32,9 +43,69 @@ def fold_min(thisdat, nmerge=370):
         thisdat = thisdat[:-(len(thisdat)%nmerge)]
     return np.nanmin(np.reshape(thisdat, (int(len(thisdat)/nmerge),nmerge)), axis=1)
 
+def calibration_peaks(trigger, chanb, chand, dt, peak=True, trig_level=1000, scales=(1., 1.), chunk=2048):
+    """
+        The monitor and receiver pulse heights (or pedestal-subtracted sums, if not `peak`) after every trigger, for `PicoMeasure.calibrate`
+        Takes the raw ADC buffers, with `trig_level` in ADC counts. Everything's done in whole ADC counts until the very end, where `scales` 
+        (mV per count on chanb and chand) bring it over to mV. That's exact, and agrees with working through the mV waveforms up to rounding
+
+        The windows after `chunk` triggers at a time are copied out of a strided (n_samples x window) view, so they're still in cache 
+        for the min and the sums. 
+        See benchmarks/calibrate.py
+    """
+    # where the sync crosses up past the trigger level. It's one long pass, so bigger chunks than usual to cut down the calls
+    finder = CrossingFinder(1<<18)
+    crossings = finder.crossings(trigger, get_level(0, trig_level, False, trigger.dtype), use_rise=True)
+
+    window = int(370 / dt)
+    skip = 0 # 42  int(0.6*window)
+
+    # only keep the triggers where the whole window fits in the capture
+    crossings = crossings[crossings + window <= len(chanb)]
+
+    # the pedestal and the sum are a small matrix product on the windows. In float32 that's still exact, as long as
+    # a window's worth of 16-bit counts fits in the 24-bit mantissa
+    sum_type = np.float32 if window * 2**15 < 2**24 else np.float64
+
+    peaks = []
+    # the monitor's pedestal comes from the end of its window. The receiver's sum takes it from the start
+    for signal, scale, ped_start in ((chanb, scales[0], window-10), (chand, scales[1], window-10 if peak else 0)):
+        # the peak only needs the pedestal columns
+        columns = slice(ped_start, ped_start+10) if peak else slice(0, window)
+        weights = np.zeros((window, 2), sum_type)
+        weights[ped_start:ped_start+10, 0] = 1
+        weights[skip:, 1] = 1
+        weights = weights[columns]
+        view = np.lib.stride_tricks.sliding_window_view(signal, window)
+        out = np.empty(len(crossings))
+        for start in range(0, len(crossings), chunk):
+            windows = view[crossings[start:start+chunk]]
+            sums = (windows[:, columns].astype(sum_type) @ weights).astype(np.float64)
+            if peak:
+                # peak distribution
+                out[start:start+chunk] = sums[:, 0]/10 - np.min(windows[:, skip:], axis=1)
+            else:
+                # waveform sum with pedestal subtraction. Only the windows get summed, not the whole capture
+                out[start:start+chunk] = sums[:, 1]/window - sums[:, 0]/10
+        peaks.append(out*scale)
+    return peaks[0], peaks[1]
+
+def ratio_precision(mon, rec, mon_dark, rec_dark):
+    """
+        Relative (Poisson) uncertainty on the dark-subtracted receiver/monitor ratio, (rec - rec_dark)/(mon - mon_dark)
+        Infinite until both have a signal over their dark counts
+    """
+    mon_signal = mon - mon_dark
+    rec_signal = rec - rec_dark
+    if mon_signal<=0 or rec_signal<=0:
+        return np.inf
+    return float(np.sqrt((rec + rec_dark)/rec_signal**2 + (mon + mon_dark)/mon_signal**2))
 
 class PicoMeasure:
-    def __init__(self, block_mode = False):
+    def __init__(self, block_mode = False, segmented=False, hugepages=False, backend=None):
+        # the ps3000a driver, or something that stands in for it (like a replay.ReplayDriver)
+        self._ps = ps if backend is None else backend
+        self._enums = picoEnum if backend is None else backend
         self.nextSample = 0
         self.bped = 0 # 1.54
         self.dped = 0 # 3.54 -0.5
@@ -42,9 +113,70 @@ class PicoMeasure:
         self.wasCalledBack = False
         self._initialized = False
         self._block_mode = block_mode
+        # overlap the capture of one block with the analysis of the last (block mode only)
+        self.pipelined = False
+        # look for pulses in the raw ADC counts, rather than converting all the waveforms to mV
+        self.adc_domain = True
+        # stream without stopping, analysing the data as it arrives (stream mode only)
+        self.continuous = False
+
+        # trigger on the LED sync and only capture a short segment around each flash (block mode only)
+        self.segmented = segmented
+        self.n_segments = 4096
+        self.segment_samples = 256
+        self.segment_pretrigger = 16
+        # each segment auto-triggers after this long without a sync, so a block with the LED off still finishes (in n_segments times this)
+        self.segment_auto_trigger_ms = 1
+        self._last_live_time = 0
+        # samples per block (unsegmented block mode). See `autotune`
+        self.block_samples = 370*100000
+        self.autotune_report = None
+
+        # how long, in seconds, to wait on the scope for a block before giving up
+        self.ready_timeout = 10
+        self._ready = BlockReady(driver=self._ps)
+        self._spare_buffers = None
+        # analyses pipelined blocks, and holds the counts of the last measurement until they're done
+        self._analysis_worker = None
+        self._last_future = None
+        # all of the capture buffers live in one arena, optionally backed by huge pages. See `_allocate_buffers`
+        self.hugepages = hugepages
+        self._arena = None
+        # split the analysis of each capture over a pool of processes. See `use_analysis_pool`
+        self._pool = None
+        # (monitor, receiver) TimingHistograms filled from every capture. See `monitor_timing`
+        self.timing = None
+        # per-stage timers, off (a NullTimer) unless `enable_timing` is called
+        self.timer = NULL_TIMER
+        # a PulseRecordWriter getting a record for every trigger. See `record_pulses`
+        self.pulse_writer = None
+        self._pulse_offset = 0
+        # a SnapshotWriter keeping the first `snapshot_samples` of any block whose mon/rec ratio is more than `snapshot_tolerance` off. See `keep_snapshots`
+        self.snapshot_writer = None
+        self.snapshot_tolerance = 0.2
+        self.snapshot_samples = 1<<20
+        self._last_max_adc = None
         print("In {} mode".format("block" if block_mode else "stream"))
         self.collection_time = 30
 
+        # instead of a fixed collection_time, stop once the rec/mon ratio is known to `target_precision` (relative)
+        # but never before min_collection_time, or after max_collection_time [s]
+        self.adaptive = False
+        self.target_precision = 0.01
+        self.min_collection_time = 2
+        self.max_collection_time = 120
+        # relative uncertainty on the ratio from the last measurement
+        self.last_precision = np.inf
+        # set this (from any thread) to cut the measurement in progress short. Stays set until it's cleared 
+        self.abort = threading.Event()
+
+        # called with a dict of the running totals and rates while measuring, at most every `progress_interval` seconds. See `_report`
+        self.on_progress = None
+        self.progress_interval = 1.
+        self._progress_last = None
+        # driver overflow flags (bit per channel) OR'd over the current measurement
+        self._overflow = 0
+
         self.rec_lt_good = 40./376
         self.mon_lt_good = 40./376
 
@@ -70,7 +202,7 @@ class PicoMeasure:
     def start(self):
 
         # Open PicoScope 5000 Series device
-        self.status["openunit"] = ps.ps3000aOpenUnit(ctypes.byref(self.chandle), None)
+        self.status["openunit"] = self._ps.ps3000aOpenUnit(ctypes.byref(self.chandle), None)
 
         try:
             assert_pico_ok(self.status["openunit"])
@@ -80,9 +212,9 @@ class PicoMeasure:
 
             # try powering it up in a few ways. AC adapter or USB 
             if powerStatus == 286:
-                self.status["changePowerSource"] = ps.ps3000aChangePowerSource(self.chandle, powerStatus)
+                self.status["changePowerSource"] = self._ps.ps3000aChangePowerSource(self.chandle, powerStatus)
             elif powerStatus == 282:
-                self.status["changePowerSource"] = ps.ps3000aChangePowerSource(self.chandle, powerStatus)
+                self.status["changePowerSource"] = self._ps.ps3000aChangePowerSource(self.chandle, powerStatus)
             else:
                 raise
 
@@ -101,17 +233,17 @@ class PicoMeasure:
         # coupling type = PS3000A_DC = 1
         # range = PS3000A_2V = 7
         # analogue offset = 0 V
-        self.channel_range = ps.PS3000A_RANGE['PS3000A_2V']
-        self.ch_range_2 = ps.PS3000A_RANGE['PS3000A_200MV'] 
-        self.ch_range_3 = ps.PS3000A_RANGE['PS3000A_200MV'] 
-        self.status["setChA"] = ps.ps3000aSetChannel(self.chandle,
-                                                ps.PS3000A_CHANNEL['PS3000A_CHANNEL_A'],
+        self.channel_range = self._ps.PS3000A_RANGE['PS3000A_2V']
+        self.ch_range_2 = self._ps.PS3000A_RANGE['PS3000A_200MV'] 
+        self.ch_range_3 = self._ps.PS3000A_RANGE['PS3000A_200MV'] 
+        self.status["setChA"] = self._ps.ps3000aSetChannel(self.chandle,
+                                                self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_A'],
                                                 enabled,
-                                                ps.PS3000A_COUPLING['PS3000A_DC'],
+                                                self._ps.PS3000A_COUPLING['PS3000A_DC'],
                                                 self.channel_range,
                                                 trig_off)
         
-        #ps.ps3000aGetChannelInformation()
+        #self._ps.ps3000aGetChannelInformation()
         assert_pico_ok(self.status["setChA"])
         
         # Set up channel B
@@ -121,41 +253,52 @@ class PicoMeasure:
         # coupling type = PS3000A_DC = 1
         # range = PS3000A_2V = 7
         # analogue offset = 0 V
-        self.status["setChB"] = ps.ps3000aSetChannel(self.chandle,
-                                                ps.PS3000A_CHANNEL['PS3000A_CHANNEL_B'],
+        self.status["setChB"] = self._ps.ps3000aSetChannel(self.chandle,
+                                                self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_B'],
                                                 enabled,
-                                                ps.PS3000A_COUPLING['PS3000A_DC'],
+                                                self._ps.PS3000A_COUPLING['PS3000A_DC'],
                                                 self.ch_range_2,
                                                 analogue_offset)
         assert_pico_ok(self.status["setChB"])
-        self.status["setChC"] = ps.ps3000aSetChannel(self.chandle,
-                                                ps.PS3000A_CHANNEL['PS3000A_CHANNEL_C'],
+        self.status["setChC"] = self._ps.ps3000aSetChannel(self.chandle,
+                                                self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_C'],
                                                 disabled,
-                                                ps.PS3000A_COUPLING['PS3000A_DC'],
+                                                self._ps.PS3000A_COUPLING['PS3000A_DC'],
                                                 self.ch_range_2,
                                                 analogue_offset)
         assert_pico_ok(self.status["setChC"])       
 
-        self.status["setChD"] = ps.ps3000aSetChannel(self.chandle,
-                                                ps.PS3000A_CHANNEL['PS3000A_CHANNEL_D'],
+        self.status["setChD"] = self._ps.ps3000aSetChannel(self.chandle,
+                                                self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_D'],
                                                 enabled,
-                                                ps.PS3000A_COUPLING['PS3000A_DC'],
+                                                self._ps.PS3000A_COUPLING['PS3000A_DC'],
                                                 self.ch_range_3,
                                                 analogue_offset)
         assert_pico_ok(self.status["setChD"])
         
 
-        bw = picoEnum.PICO_BANDWIDTH_LIMITER["PICO_BW_FULL"]
-        self.status["band"] = ps.ps3000aSetBandwidthFilter( self.chandle, ps.PS3000A_CHANNEL['PS3000A_CHANNEL_A'], bw)
+        bw = self._enums.PICO_BANDWIDTH_LIMITER["PICO_BW_FULL"]
+        self.status["band"] = self._ps.ps3000aSetBandwidthFilter( self.chandle, self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_A'], bw)
         assert_pico_ok(self.status["band"])
-        self.status["band"] = ps.ps3000aSetBandwidthFilter( self.chandle, ps.PS3000A_CHANNEL['PS3000A_CHANNEL_B'], bw)
+        self.status["band"] = self._ps.ps3000aSetBandwidthFilter( self.chandle, self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_B'], bw)
         assert_pico_ok(self.status["band"])
-        self.status["band"] = ps.ps3000aSetBandwidthFilter( self.chandle, ps.PS3000A_CHANNEL['PS3000A_CHANNEL_D'], bw)
+        self.status["band"] = self._ps.ps3000aSetBandwidthFilter( self.chandle, self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_D'], bw)
         assert_pico_ok(self.status["band"])
+        self._configure_capture()
+
+    def _configure_capture(self):
+        """
+            Sizes the capture, lays out the buffers for it, and sets up the scope's memory to match
+            Called again whenever the block size changes 
+        """
         # Size of capture
-        # we want a lot of these. The more the better. Eventually reached diminishing returns 
-        if self._block_mode:
-            self.sizeOfOneBuffer = 370*100000
+        # we want a lot of these. The more the better. Eventually reached diminishing returns (see `autotune`)
+        if self._block_mode and self.segmented:
+            # totalSamples is per capture, and we capture one segment per flash
+            self.totalSamples = self.segment_samples
+            self.sizeOfOneBuffer = self.n_segments*self.segment_samples
+        elif self._block_mode:
+            self.sizeOfOneBuffer = self.block_samples
             self.totalSamples = self.sizeOfOneBuffer*1
         else:
             self.sizeOfOneBuffer = 500 # 0000
@@ -165,10 +308,7 @@ class PicoMeasure:
 
             self.totalSamples = self.sizeOfOneBuffer * numBuffersToCapture
 
-        # Create buffers ready for assigning pointers for data collection
-        self.bufferAMax = np.zeros(shape=self.sizeOfOneBuffer, dtype=np.int16)
-        self.bufferBMax = np.zeros(shape=self.sizeOfOneBuffer, dtype=np.int16)
-        self.bufferDMax = np.zeros(shape=self.sizeOfOneBuffer, dtype=np.int16)
+        self._allocate_buffers()
         self.memory_segment = 0
 
         # Set data buffer location for data collection from channel A
@@ -179,13 +319,13 @@ class PicoMeasure:
         # buffer length = maxSamples
         # segment index = 0
         # ratio mode = PS3000A_RATIO_MODE_NONE = 0
-        self.status["setDataBuffersA"] = ps.ps3000aSetDataBuffers(self.chandle,
-                                                            ps.PS3000A_CHANNEL['PS3000A_CHANNEL_A'],
+        self.status["setDataBuffersA"] = self._ps.ps3000aSetDataBuffers(self.chandle,
+                                                            self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_A'],
                                                             self.bufferAMax.ctypes.data_as(ctypes.POINTER(ctypes.c_int16)),
                                                             None,
                                                             self.sizeOfOneBuffer,
                                                             self.memory_segment,
-                                                            ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'])
+                                                            self._ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'])
         assert_pico_ok(self.status["setDataBuffersA"])
         
         # Set data buffer location for data collection from channel B
@@ -196,22 +336,22 @@ class PicoMeasure:
         # buffer length = maxSamples
         # segment index = 0
         # ratio mode = PS3000A_RATIO_MODE_NONE = 0
-        self.status["setDataBuffersB"] = ps.ps3000aSetDataBuffers(self.chandle,
-                                                            ps.PS3000A_CHANNEL['PS3000A_CHANNEL_B'],
+        self.status["setDataBuffersB"] = self._ps.ps3000aSetDataBuffers(self.chandle,
+                                                            self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_B'],
                                                             self.bufferBMax.ctypes.data_as(ctypes.POINTER(ctypes.c_int16)),
                                                             None,
                                                             self.sizeOfOneBuffer,
                                                             self.memory_segment,
-                                                            ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'])
+                                                            self._ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'])
         assert_pico_ok(self.status["setDataBuffersB"])
         
-        self.status["setDataBuffersD"] = ps.ps3000aSetDataBuffers(self.chandle,
-                                                            ps.PS3000A_CHANNEL['PS3000A_CHANNEL_D'],
+        self.status["setDataBuffersD"] = self._ps.ps3000aSetDataBuffers(self.chandle,
+                                                            self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_D'],
                                                             self.bufferDMax.ctypes.data_as(ctypes.POINTER(ctypes.c_int16)),
                                                             None,
                                                             self.sizeOfOneBuffer,
                                                             self.memory_segment,
-                                                            ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'])
+                                                            self._ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'])
         assert_pico_ok(self.status["setDataBuffersD"])
         
         self.sampleInterval = ctypes.c_int32(8)
@@ -221,28 +361,311 @@ class PicoMeasure:
             self._timebase = 2
             timeIntervalns = ctypes.c_float()
             returnedMaxSamples = ctypes.c_int32()
-            n_segments= 1
+            n_segments= self.n_segments if self.segmented else 1
 
-            status= ps.ps3000aGetTimebase2(self.chandle, self._timebase, self.totalSamples, ctypes.byref(timeIntervalns), 1, ctypes.byref(returnedMaxSamples), 0)
+            status= self._ps.ps3000aGetTimebase2(self.chandle, self._timebase, self.totalSamples, ctypes.byref(timeIntervalns), 1, ctypes.byref(returnedMaxSamples), 0)
             
             self.actualSampleInterval = timeIntervalns.value
             self.actualSampleIntervalNs = self.actualSampleInterval
             self.cmax = ctypes.c_int32(self.totalSamples)
             assert_pico_ok(status)
-            status=ps.ps3000aMemorySegments(self.chandle, n_segments, ctypes.byref(self.cmax))
+            status=self._ps.ps3000aMemorySegments(self.chandle, n_segments, ctypes.byref(self.cmax))
             assert_pico_ok(status)
-            status=ps.ps3000aSetNoOfCaptures(self.chandle, n_segments)
+            # the driver hands back how many samples each segment can hold 
+            self.max_block_samples = self.cmax.value
+            status=self._ps.ps3000aSetNoOfCaptures(self.chandle, n_segments)
+            assert_pico_ok(status)
+            if self.segmented:
+                self._setup_segments()
+
+    def _setup_segments(self):
+        """
+            Trigger on the LED sync (channel A) and give each memory segment its own slice of the buffers 
+        """
+        maxADC = ctypes.c_int16()
+        status = self._ps.ps3000aMaximumValue(self.chandle, ctypes.byref(maxADC))
+        assert_pico_ok(status)
+
+        # rising edge, and auto-trigger after segment_auto_trigger_ms so we don't hang if the LED is off
+        self.status["trigger"] = self._ps.ps3000aSetSimpleTrigger(self.chandle, 1, self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_A'], int(mV2adc(1000, self.channel_range, maxADC)), 2, 0, self.segment_auto_trigger_ms)
+        assert_pico_ok(self.status["trigger"])
+
+        for channel, buffer in (("A", self.bufferAMax), ("B", self.bufferBMax), ("D", self.bufferDMax)):
+            segments = buffer.reshape(self.n_segments, self.segment_samples)
+            for i in range(self.n_segments):
+                status = self._ps.ps3000aSetDataBuffer(self.chandle, self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_{}'.format(channel)], segments[i].ctypes.data, self.segment_samples, i, self._ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'])
+                assert_pico_ok(status)
     
+    def use_analysis_pool(self, workers=4):
+        """
+            Analyse each capture across `workers` processes 
+            The capture buffers are moved into shared memory, so the workers can read them without copying anything 
+            Only used for the ADC-count analysis of whole blocks/streaming captures
+        """
+        self._pool = AnalysisPool(workers)
+        # the driver still has the old buffers, so lay them out again (shared this time) and hand them over
+        self._configure_capture()
+
+    def _share_buffers(self):
+        self.bufferAMax = self._pool.share(self.bufferAMax, "A")
+        self.bufferBMax = self._pool.share(self.bufferBMax, "B")
+        self.bufferDMax = self._pool.share(self.bufferDMax, "D")
+        self._spare_buffers = None
+        if not self._block_mode:
+            self.bufferCompleteA = self._pool.share(self.bufferCompleteA, "completeA")
+            self.bufferCompleteB = self._pool.share(self.bufferCompleteB, "completeB")
+            self.bufferCompleteD = self._pool.share(self.bufferCompleteD, "completeD")
+
+    def monitor_timing(self, bins=173, min_time=0, max_time=346):
+        """
+            Keep running histograms of the trigger-to-hit times (in ns) on the monitor and receiver, from every capture 
+            Read them from `self.timing`. Not filled when the analysis is split over a pool
+        """
+        self.timing = (TimingHistogram(bins, min_time, max_time), TimingHistogram(bins, min_time, max_time))
+
+    def record_pulses(self, path, **kwargs):
+        """
+            Write a record of every trigger (pulse heights, times, charges, and flags) to the HDF5 file at `path`, from every capture from now on
+            Heights are in mV and charges in mV ns. Not written when the analysis is split over a pool, or when streaming continuously 
+            `kwargs` go to the PulseRecordWriter
+        """
+        from wms_midas.utilities.storage import PulseRecordWriter
+
+        self.stop_recording_pulses()
+        attrs = {
+            "dt":self.actualSampleIntervalNs,
+            "threshold":thresh,
+            "windows":COUNT_WINDOWS,
+            "search_window":SEARCH_WINDOW,
+        }
+        self.pulse_writer = PulseRecordWriter(path, attrs=attrs, **kwargs)
+        self._pulse_offset = 0
+
+    def stop_recording_pulses(self):
+        if self.pulse_writer is not None:
+            self.pulse_writer.close()
+            self.pulse_writer = None
+
+    def _record_pulses(self, ctime, chanb, chand, mon_thresh, rec_thresh, mon_ped, rec_ped, scale=(1., 1.)):
+        """
+            Send the records for one capture to the pulse writer. `scale` takes the monitor and receiver over to mV
+        """
+        records = pulse_records(ctime, chanb, chand, mon_thresh, rec_thresh, self.actualSampleIntervalNs, mon_ped, rec_ped, self._pulse_offset)
+        self._pulse_offset += len(chanb)
+        for field in ("mon_amp", "mon_charge", "mon_dark_amp"):
+            records[field] *= scale[0]
+        for field in ("rec_amp", "rec_charge", "rec_dark_amp"):
+            records[field] *= scale[1]
+        if self._overflow:
+            records["flags"] |= FLAG_SATURATED
+        self.pulse_writer.append(records)
+
+    def keep_snapshots(self, directory, tolerance=0.2, samples=1<<20, **kwargs):
+        """
+            Keep the raw waveforms of any capture whose mon/rec ratio is more than `tolerance` (relative) off of the measurement so far
+            Only the first `samples` of each channel are kept (about 4 ms at 4 ns), so a snapshot is a few MB rather than the whole block
+            They're written to `directory` in the background, see SnapshotWriter for the rest of the `kwargs` (disk cap, rotation...)
+            Not done for continuous streaming measurements, the buffers are already being reused by the time the counts are in
+        """
+        from wms_midas.utilities.storage import SnapshotWriter
+
+        self.stop_snapshots()
+        self.snapshot_tolerance = tolerance
+        self.snapshot_samples = samples
+        self.snapshot_writer = SnapshotWriter(directory, **kwargs)
+
+    def stop_snapshots(self):
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.close()
+            self.snapshot_writer = None
+
+    def _check_snapshot(self, counts, totals, bufferA, bufferB, bufferD, maxADC):
+        """
+            Hand the capture to the snapshot writer if its counts look off compared to the `totals` before it
+        """
+        from wms_midas.utilities.storage import ratio_anomaly
+
+        if self.snapshot_writer is None or not ratio_anomaly(counts, totals, self.snapshot_tolerance):
+            return
+        window = slice(0, self.snapshot_samples)
+        self.snapshot_writer.submit({"chana":bufferA[window], "chanb":bufferB[window], "chand":bufferD[window]}, {
+            # where the snapshot starts in its block, and how long the block was
+            "offset":0,
+            "block_samples":len(bufferA),
+            "interval_ns":self.actualSampleIntervalNs,
+            # index into channelInputRanges
+            "ranges":[self.channel_range, self.ch_range_2, self.ch_range_3],
+            "range_mV":[channelInputRanges[rang] for rang in (self.channel_range, self.ch_range_2, self.ch_range_3)],
+            "maxADC":maxADC.value,
+            "ped_mV":[0, self.bped, self.dped],
+            "counts":[int(entry) for entry in counts],
+            "totals":[int(entry) for entry in totals],
+        })
+
+    def _report(self, elapsed, counts):
+        """
+            Send the running totals, the rates since the last report, and which channels have saturated, to `on_progress`
+        """
+        now = time.time()
+        counts = [int(entry) for entry in counts]
+        if self._progress_last is None:
+            # first block of the measurement, the rates are since the start
+            self._progress_last = (now - elapsed, [0]*5)
+        elif (now - self._progress_last[0])<self.progress_interval:
+            return
+        last_time, last_counts = self._progress_last
+        interval = max(now - last_time, 1e-9)
+        self._progress_last = (now, counts)
+
+        trig, mon, rec, mond, recd = counts
+        self.on_progress({
+            "elapsed":elapsed,
+            "trig":trig,
+            "mon":mon,
+            "rec":rec,
+            "mon_dark":mond,
+            "rec_dark":recd,
+            "trig_rate":(trig - last_counts[0])/interval,
+            "mon_rate":(mon - last_counts[1])/interval,
+            "rec_rate":(rec - last_counts[2])/interval,
+            "precision":ratio_precision(mon, rec, mond, recd),
+            # channels A, B, D
+            "saturated":[bool(self._overflow & (1<<channel)) for channel in (0, 1, 3)],
+        })
+
+    def enable_timing(self, size=1024):
+        """
+            Start timing each stage of every block (arming, waiting, transfer, conversion, crossings, coincidences...) for the last `size` blocks
+            See `timing_summary`
+        """
+        self.timer = StageTimer(TIMED_STAGES, size)
+
+    def disable_timing(self):
+        self.timer = NULL_TIMER
+
+    def timing_summary(self, percentiles=(50, 90, 99)):
+        """
+            Percentiles of the time per block spent in each stage, each stage's share of the time, and the live fraction. None if timing is off
+        """
+        return self.timer.summary(percentiles)
+
+    def _buffer_layout(self):
+        """
+            The buffers the current mode reads. Channel C is never enabled, so it never gets one 
+        """
+        layout = {"A":self.sizeOfOneBuffer, "B":self.sizeOfOneBuffer, "D":self.sizeOfOneBuffer}
+        if not self._block_mode:
+            # We need a big buffer, not registered with the driver, to keep our complete capture in.
+            # In continuous mode this is used as a ring buffer 
+            layout.update({"completeA":self.totalSamples, "completeB":self.totalSamples, "completeD":self.totalSamples})
+        return layout
+
+    def _allocate_buffers(self):
+        """
+            Lay the capture buffers out in one arena, and point the buffer attributes at it
+            The arena is reused as long as the layout doesn't change
+        """
+        layout = self._buffer_layout()
+        if self._arena is None or not self._arena.matches(layout, self.hugepages):
+            self._arena = BufferArena(layout, hugepages=self.hugepages)
+        self.bufferAMax = self._arena["A"]
+        self.bufferBMax = self._arena["B"]
+        self.bufferDMax = self._arena["D"]
+        if not self._block_mode:
+            self.bufferCompleteA = self._arena["completeA"]
+            self.bufferCompleteB = self._arena["completeB"]
+            self.bufferCompleteD = self._arena["completeD"]
+        self._spare_buffers = None
+        if self._pool is not None:
+            self._share_buffers()
+
+    def autotune(self, sizes=(1000000, 4000000, 10000000, 20000000, 37000000, 50000000), memory_budget=1<<30, blocks=2):
+        """
+            Picks the block size (in samples) with the best live-time fraction, out of `sizes`, whose buffers fit in `memory_budget` bytes
+            Each size is tried for `blocks` blocks, timing the capture, the transfer off the scope, and the analysis 
+
+            Why it picked what it did is in `autotune_report`. Unsegmented block mode only 
+        """
+        if not self._block_mode or self.segmented:
+            raise ValueError("Can only autotune the block size in (unsegmented) block mode")
+        # the last measurement might still be analysing out of the buffers we're about to replace
+        if self._last_future is not None:
+            self._last_future.result()
+
+        report = []
+        for size in sizes:
+            # A, B, D, and a second set of them when pipelining
+            memory = 3*np.dtype(np.int16).itemsize*size*(2 if self.pipelined else 1)
+            entry = {"size":size, "memory":memory}
+            report.append(entry)
+            if memory>memory_budget:
+                entry["skipped"] = "over the memory budget"
+                continue
+            if size>self.max_block_samples:
+                entry["skipped"] = "more than the scope can hold"
+                continue
+
+            self.block_samples = size
+            self._configure_capture()
+            capture = transfer = analysis = live = 0
+            for _ in range(blocks):
+                start = time.time()
+                self._arm_block()
+                self._wait_block()
+                captured = time.time()
+                maxADC = self._fetch_block(self.bufferAMax, self.bufferBMax, self.bufferDMax)
+                fetched = time.time()
+                self._analyse_block(self.bufferAMax, self.bufferBMax, self.bufferDMax, maxADC)
+                capture += captured - start
+                transfer += fetched - captured
+                analysis += time.time() - fetched
+                live += self._block_live_time()
+
+            # when pipelining, the analysis hides behind the next capture
+            cycle = transfer + (max(capture, analysis) if self.pipelined else capture + analysis)
+            entry.update({
+                "capture":capture/blocks,
+                "transfer":transfer/blocks,
+                "analysis":analysis/blocks,
+                "live_fraction":live/cycle,
+            })
+
+        tried = [entry for entry in report if "live_fraction" in entry]
+        if len(tried)==0:
+            raise ValueError("None of the block sizes {} fit".format(sizes))
+        best = max(tried, key=lambda entry:entry["live_fraction"])
+        self.block_samples = best["size"]
+        self._configure_capture()
+        self.autotune_report = {"chosen":best["size"], "memory_budget":memory_budget, "pipelined":self.pipelined, "sizes":report}
+        return best["size"]
+
+    def _new_buffer_set(self):
+        """
+            A second set of A, B, D buffers, for pipelining
+        """
+        if self._pool is None:
+            arena = BufferArena({"A":self.sizeOfOneBuffer, "B":self.sizeOfOneBuffer, "D":self.sizeOfOneBuffer}, hugepages=self.hugepages)
+            return arena["A"], arena["B"], arena["D"]
+        return tuple(self._pool.share(np.zeros_like(buffer), "spare"+key) for key, buffer in (("A", self.bufferAMax), ("B", self.bufferBMax), ("D", self.bufferDMax)))
+
     def close(self):
+        if self._analysis_worker is not None:
+            self._analysis_worker.shutdown()
+            self._analysis_worker = None
+        self.stop_recording_pulses()
+        self.stop_snapshots()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
                 
         # Stop the scope
         # handle = chandle
-        self.status["stop"] = ps.ps3000aStop(self.chandle)
+        self.status["stop"] = self._ps.ps3000aStop(self.chandle)
         assert_pico_ok(self.status["stop"])
 
         # Disconnect the scope
         # handle = chandle
-        self.status["close"] = ps.ps3000aCloseUnit(self.chandle)
+        self.status["close"] = self._ps.ps3000aCloseUnit(self.chandle)
         assert_pico_ok(self.status["close"])
 
     def calibrate(self, hack=False, peak=True):
@@ -253,7 +676,12 @@ class PicoMeasure:
             Make distribution. Run fit. 
             Get threshold
         """
-        trigger, chanb, chand = self.measure(True)
+        # the raw ADC counts, only the peaks get converted over to mV
+        trigger, chanb, chand = self.measure(True, True)
+        maxADC = ctypes.c_int16()
+        status = self._ps.ps3000aMaximumValue(self.chandle, ctypes.byref(maxADC))
+        assert_pico_ok(status)
+        scales = (channelInputRanges[self.ch_range_2]/maxADC.value, channelInputRanges[self.ch_range_3]/maxADC.value)
         #time_sample = np.linspace(0, (self.totalSamples - 1) * self.sampleIntervalNs, self.totalSamples)
         if peak:
             bins = np.linspace(0, 200, 129)
@@ -261,38 +689,11 @@ class PicoMeasure:
             bins = np.linspace(-20, 20, 129)
         
         if hack:
-            mon_peaks = -1*fold_min(chanb, nmerge=370)
-            rec_peaks = -1*fold_min(chand, nmerge=370)
+            # against the pedestals, which the mV waveforms used to have taken off
+            mon_peaks = -scales[0]*fold_min(chanb, nmerge=370) + self.bped
+            rec_peaks = -scales[1]*fold_min(chand, nmerge=370) + self.dped
         else:
-            # we drop this down to just a difference in the sign (-2, 0, +2)
-            # but shifted down by the threshold 
-            # so +2 is crossing up, -2 is crossing down, 0 is staying above/below 
-            crossings = np.diff(np.sign(trigger - 1000))
-            #  call the crossing-down ones nothing
-            crossings[crossings<0] = 0
-            # and get the places where we are crossing up. hit times! 
-            crossings = np.where(crossings)[0]
-
-            window = int(370 / self.actualSampleIntervalNs)
-            skip = 0 # 42  int(0.6*window)
-            
-            mon_peaks = []
-            rec_peaks = []
-            for ic in crossings:
-                if len(chanb[ic+skip:ic+window])==0:
-                    continue
-                #print(window*np.sum(chanb[ic+360:ic+window])/10)
-                # peak distribution
-                if peak:
-                    mon_peaks.append(-1*np.min(chanb[ic+skip:ic+window]) + np.mean(chanb[ic+window-10:ic+window]))
-                    rec_peaks.append(-1*np.min(chand[ic+skip:ic+window]) + np.mean(chand[ic+window-10:ic+window]) )
-                else:
-                # waveform sum with pedestal subtraction
-                    mon_peaks.append(np.sum(chanb[ic+skip:ic+window])/window - np.sum(chanb[ic+window-10:ic+window]/10) )
-                    rec_peaks.append(np.sum(chand[ic+skip:ic+window])/window - np.sum(chand[ic:ic+10])/10)
-
-                #mon_peaks.append(np.sum(chanb[ic+skip:ic+window]) )
-                #rec_peaks.append(np.sum(chand[ic+skip:ic+window]) -400)
+            mon_peaks, rec_peaks = calibration_peaks(trigger, chanb, chand, self.actualSampleIntervalNs, peak, mV2adc(1000, self.channel_range, maxADC), scales)
 
         print(np.mean(mon_peaks))
         print(np.mean(rec_peaks))
@@ -314,11 +715,94 @@ class PicoMeasure:
         _obj.close()
         return out_data
 
+    def threshold_scan(self, thresholds):
+        """
+            Coincidence counts at every one of the `thresholds` [mV], all from a single capture
+
+            Rather than finding the hits again for each threshold, we take how deep each channel dips in every window after every trigger once.
+            A pulse is counted at a threshold if it dips deeper than it, so each curve is just a sort and a cumulative count
+
+            Returns the thresholds, the number of triggers, and the mon, rec, mon dark, rec dark counts at each threshold
+
+            The scan works on the raw ADC counts, the same way in block and stream mode, with the pedestals found around `bped`/`dped` 
+            like the counting does. The depths are only converted to mV at the end
+        """
+        thresholds = np.asarray(thresholds, dtype=float)
+        trigger, chanb, chand = self.measure(True, True)
+        dt = self.actualSampleIntervalNs
+
+        maxADC = ctypes.c_int16()
+        status = self._ps.ps3000aMaximumValue(self.chandle, ctypes.byref(maxADC))
+        assert_pico_ok(status)
+        trig_level, mon_thresh, rec_thresh, mon_ped, rec_ped = self._adc_levels(maxADC)
+
+        trigs = get_cfd_time(trigger, trig_level, auto_adjust_ped=False, use_rise=True)
+        finder = get_crossing_finder()
+        mon_ped = finder.pedestal(chanb, mon_ped, 0.66*mon_thresh)
+        rec_ped = finder.pedestal(chand, rec_ped, 0.66*rec_thresh)
+
+        # mon and mon dark windows on the monitor, rec and rec dark on the receiver
+        mon = pulse_amplitudes(trigs, chanb, COUNT_WINDOWS[[0, 2]], mon_ped, dt)*channelInputRanges[self.ch_range_2]/maxADC.value
+        rec = pulse_amplitudes(trigs, chand, COUNT_WINDOWS[[1, 3]], rec_ped, dt)*channelInputRanges[self.ch_range_3]/maxADC.value
+        return {
+            "thresholds":thresholds.tolist(),
+            "trig":int(mon.shape[1]),
+            "mon":threshold_counts(mon[0], thresholds).tolist(),
+            "rec":threshold_counts(rec[0], thresholds).tolist(),
+            "mon_dark":threshold_counts(mon[1], thresholds).tolist(),
+            "rec_dark":threshold_counts(rec[1], thresholds).tolist(),
+        }
+
     def measure(self, give_waves=False, raw_dat = False):
+        """
+            Collect for `collection_time` seconds (or until `target_precision` is reached, when `adaptive`). Returns 
+                triggers, monitor hits, receiver hits, monitor dark hits, receiver dark hits, live time [s], dead time [s]
+            
+            If `give_waves` is set, we instead return the waveforms of the first capture 
+        """
+        if give_waves:
+            self._overflow = 0
+            self._progress_last = None
+            if self._block_mode:
+                return self._rapidblock(give_waves, raw_dat)
+            return self._stream(give_waves, raw_dat)
+        return self.measure_async().result()
+
+    def measure_async(self):
+        """
+            Same as `measure`, but returns a Future for the counts as soon as the scope is done capturing 
+            In pipelined block mode the last blocks are still being analysed, so something else (like moving the stage) can happen in the meantime
+            Otherwise the Future is already done 
+        """
+        self._overflow = 0
+        self._progress_last = None
+        if self._block_mode and self.pipelined and not self.segmented:
+            return self._rapidblock_pipelined()
+
         if self._block_mode:
-            return self._rapidblock(give_waves, raw_dat)
+            result = self._rapidblock(False, False)
         else:
-            return self._stream(give_waves, raw_dat)
+            result = self._stream(False, False)
+        self.last_precision = ratio_precision(*result[1:5])
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def _done(self, start, counts):
+        """
+            Whether a measurement that began at `start` should stop, given its running counts so far 
+            (triggers, monitor, receiver, monitor dark, receiver dark)
+        """
+        elapsed = time.time() - start
+        if self.on_progress is not None:
+            self._report(elapsed, counts)
+        if self.abort.is_set():
+            return True
+        if not self.adaptive:
+            return elapsed>=self.collection_time
+        if elapsed>=self.max_collection_time:
+            return True
+        return elapsed>=self.min_collection_time and ratio_precision(*counts[1:5])<=self.target_precision
     def _rapidblock(self, give_waves, raw_dat):
         start = time.time()
         trig = 0
@@ -326,71 +810,263 @@ class PicoMeasure:
         mond = 0
         rec = 0
         recd = 0
+        live = 0
 
-        while (time.time() - start)<self.collection_time:
+        while not self._done(start, (trig, mon, rec, mond, recd)):
             res = self._rbe(give_waves, raw_dat)
             if give_waves:
                 return res 
+            self._check_snapshot(res, (trig, mon, rec, mond, recd), self.bufferAMax, self.bufferBMax, self.bufferDMax, self._last_max_adc)
             trig += res[0]
             mon += res[1]
             rec += res[2]
             mond+= res[3]
             recd+= res[4]
-        return trig, mon, rec, mond, recd
+            live += self._last_live_time
+            self.timer.end_block(self._last_live_time)
+        dead = (time.time() - start) - live
+        return trig, mon, rec, mond, recd, live, dead
 
-    def _rbe(self, give_waves=False, raw_dat=False):
-        status = ps.ps3000aRunBlock(self.chandle, 0, self.totalSamples, self._timebase, 1, None, 0, None, None) 
-        assert_pico_ok(status)
+    def _rapidblock_pipelined(self):
+        """
+            Same as _rapidblock, but the scope is re-armed as soon as a block has been pulled off of it.
+            The analysis of that block happens on a worker thread while the next one is being captured, 
+            so we flip between two sets of buffers 
 
-        ready= ctypes.c_int(0)
-        while ready==ctypes.c_int(0):
-            status = ps.ps3000aIsReady(self.chandle, ctypes.byref(ready))
-            time.sleep(0.04)
+            Returns a Future for the counts as soon as the last block is off the scope. Its analysis carries on in the background 
+        """
+        if self._spare_buffers is None:
+            self._spare_buffers = self._new_buffer_set()
+        if self._analysis_worker is None:
+            self._analysis_worker = ThreadPoolExecutor(max_workers=1)
+        worker = self._analysis_worker
+        buffer_sets = [(self.bufferAMax, self.bufferBMax, self.bufferDMax), self._spare_buffers]
+        pending = [None, None]
 
-        self.bufferAMax*=0
-        self.bufferBMax*=0
-        self.bufferDMax*=0
-        status = ps.ps3000aSetDataBuffer(self.chandle, ps.PS3000A_CHANNEL['PS3000A_CHANNEL_A'], self.bufferAMax.ctypes.data,  self.totalSamples, 0, ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'])
-        assert_pico_ok(status)
-        status = ps.ps3000aSetDataBuffer(self.chandle, ps.PS3000A_CHANNEL['PS3000A_CHANNEL_B'], self.bufferBMax.ctypes.data,self.totalSamples, 0, ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'])
-        assert_pico_ok(status)
-        status = ps.ps3000aSetDataBuffer(self.chandle, ps.PS3000A_CHANNEL['PS3000A_CHANNEL_D'], self.bufferDMax.ctypes.data,  self.totalSamples, 0, ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'])
+        start = time.time()
+        totals = np.zeros(5, dtype=int)
+        live = 0
+        which = 0
+        # what the worker has counted so far. Only it touches this, and it goes through the blocks in order
+        analysed = np.zeros(5, dtype=int)
+        def analyse(buffers, maxADC):
+            # the buffers aren't refilled until this is done, so they can still be snapshotted here
+            counts = self._analyse_block(*buffers, maxADC)
+            self._check_snapshot(counts, analysed, *buffers, maxADC)
+            analysed[:] += counts
+            return counts
+        self._arm_block()
+        # the last measurement may still be analysing out of these buffers. The scope is already capturing, so waiting here is free
+        if self._last_future is not None:
+            self._last_future.result()
+        while True:
+            self._wait_block()
+
+            # the worker may still be chewing on the last block that used these buffers
+            if pending[which] is not None:
+                totals += pending[which].result()
+                pending[which] = None
+
+            maxADC = self._fetch_block(*buffer_sets[which])
+            live += self._block_live_time()
+            self.timer.end_block(self._block_live_time())
+
+            # the counts lag a block behind, the last one is still being analysed
+            keep_going = not self._done(start, totals)
+            if keep_going:
+                self._arm_block()
+            pending[which] = worker.submit(analyse, buffer_sets[which], maxADC)
+            which = 1 - which 
+            if not keep_going:
+                break
+
+        dead = (time.time() - start) - live
+        def finish():
+            # there's only the one worker, so the blocks still pending were all analysed before this runs
+            counts = totals.copy()
+            for job in pending:
+                if job is not None:
+                    counts += job.result()
+            trig, mon, rec, mond, recd = [int(entry) for entry in counts]
+            self.last_precision = ratio_precision(mon, rec, mond, recd)
+            return trig, mon, rec, mond, recd, live, dead
+        self._last_future = worker.submit(finish)
+        return self._last_future
+
+    def _block_live_time(self):
+        """
+            Time, in seconds, that the scope is actually looking at the channels for one block 
+        """
+        return self.totalSamples*self.actualSampleIntervalNs*1e-9
+
+    def _arm_block(self):
+        with self.timer.time("arm"):
+            status = self._ps.ps3000aRunBlock(self.chandle, 0, self.totalSamples, self._timebase, 1, None, 0, self._ready.arm(), None) 
         assert_pico_ok(status)
 
+    def _wait_block(self, timeout=None):
+        """
+            The driver calls us back as soon as the block is ready
+            If it doesn't within `timeout` (`ready_timeout` by default), the scope is stopped so it isn't left armed
+        """
+        with self.timer.time("wait"):
+            try:
+                self._ready.wait(self.ready_timeout if timeout is None else timeout)
+            except TimeoutError:
+                self._ps.ps3000aStop(self.chandle)
+                raise
 
+    def _fetch_block(self, bufferA, bufferB, bufferD):
+        """
+            Pull the captured block off of the scope and into the given buffers. Returns the max ADC value 
+        """
+        with self.timer.time("transfer"):
+            bufferA*=0
+            bufferB*=0
+            bufferD*=0
+            status = self._ps.ps3000aSetDataBuffer(self.chandle, self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_A'], bufferA.ctypes.data,  self.totalSamples, 0, self._ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'])
+            assert_pico_ok(status)
+            status = self._ps.ps3000aSetDataBuffer(self.chandle, self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_B'], bufferB.ctypes.data,self.totalSamples, 0, self._ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'])
+            assert_pico_ok(status)
+            status = self._ps.ps3000aSetDataBuffer(self.chandle, self._ps.PS3000A_CHANNEL['PS3000A_CHANNEL_D'], bufferD.ctypes.data,  self.totalSamples, 0, self._ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'])
+            assert_pico_ok(status)
 
-        overflow = (ctypes.c_int16 * 60)()        
-        nstat = ctypes.c_int(1)
-        while nstat!=0:
-            nstat = ps.ps3000aGetValuesBulk(self.chandle, ctypes.byref(self.cmax), 0, 0,  0, ps.PS3000A_RATIO_MODE["PS3000A_RATIO_MODE_NONE"] , ctypes.byref(overflow))
-            time.sleep(0.04)
+            overflow = (ctypes.c_int16 * 60)()        
+            status = self._ps.ps3000aGetValuesBulk(self.chandle, ctypes.byref(self.cmax), 0, 0,  0, self._ps.PS3000A_RATIO_MODE["PS3000A_RATIO_MODE_NONE"] , ctypes.byref(overflow))
+            assert_pico_ok(status)
+        self._overflow |= overflow[0]
         
         maxADC = ctypes.c_int16()
-        status = ps.ps3000aMaximumValue(self.chandle, ctypes.byref(maxADC))
+        status = self._ps.ps3000aMaximumValue(self.chandle, ctypes.byref(maxADC))
         assert_pico_ok(status)
+        return maxADC
+
+    def _adc_levels(self, maxADC):
+        """
+            The trigger level, hit thresholds, and pedestals, all converted over to ADC counts 
+        """
+        trig_level = mV2adc(1000, self.channel_range, maxADC)
+        mon_thresh = mV2adc(thresh, self.ch_range_2, maxADC)
+        rec_thresh = mV2adc(thresh, self.ch_range_3, maxADC)
+        mon_ped = mV2adc(self.bped, self.ch_range_2, maxADC)
+        rec_ped = mV2adc(self.dped, self.ch_range_3, maxADC)
+        return trig_level, mon_thresh, rec_thresh, mon_ped, rec_ped
+
+    def _analyse_block(self, bufferA, bufferB, bufferD, maxADC):
+        """
+            Count the triggers, and the monitor/receiver hits (and dark hits) in one block 
+        """
+        if self.adc_domain:
+            # convert the thresholds over to ADC counts once, and leave the waveforms alone 
+            chana, chanb, chand = bufferA, bufferB, bufferD
+            trig_level, mon_thresh, rec_thresh, mon_ped, rec_ped = self._adc_levels(maxADC)
+            scale = (channelInputRanges[self.ch_range_2]/maxADC.value, channelInputRanges[self.ch_range_3]/maxADC.value)
+            if self._pool is not None and self.pulse_writer is None:
+                with self.timer.time("pool"):
+                    return self._pool.count(chana, chanb, chand, trig_level, mon_thresh, rec_thresh, self.actualSampleIntervalNs, mon_ped, rec_ped)
+        else:
+            with self.timer.time("convert"):
+                chana = adc2mV(bufferA, self.channel_range, maxADC)
+                chanb = adc2mV(bufferB, self.ch_range_2, maxADC)
+                chand = adc2mV(bufferD, self.ch_range_3, maxADC)
+            trig_level = 1000
+            mon_thresh = thresh
+            rec_thresh = thresh
+            mon_ped = self.bped
+            rec_ped = self.dped
+            scale = (1., 1.)
+
+        if self.pulse_writer is None:
+            return count_block(chana, chanb, chand, trig_level, mon_thresh, rec_thresh, self.actualSampleIntervalNs, mon_ped, rec_ped, self.timing, self.timer)
+
+        # the triggers are needed for the records too, so find them here
+        with self.timer.time("crossings"):
+            ctime = get_cfd_time(chana, trig_level, auto_adjust_ped=False, use_rise=True)
+        self._record_pulses(ctime, chanb, chand, mon_thresh, rec_thresh, mon_ped, rec_ped, scale)
+        return (len(ctime), *count_coincident(ctime, chanb, chand, mon_thresh, rec_thresh, self.actualSampleIntervalNs, mon_ped, rec_ped, self.timing, self.timer))
+
+    def _rbe(self, give_waves=False, raw_dat=False):
+        if self.segmented:
+            return self._rbe_segments(give_waves, raw_dat)
+
+        self._arm_block()
+        self._wait_block()
+        maxADC = self._fetch_block(self.bufferAMax, self.bufferBMax, self.bufferDMax)
+        self._last_live_time = self._block_live_time()
+        self._last_max_adc = maxADC
+
         if give_waves:
             if raw_dat:
                 return self.bufferAMax, self.bufferBMax, self.bufferDMax     
-        adc2mVChAMax = adc2mV(self.bufferAMax, self.channel_range, maxADC)
-        adc2mVChBMax = adc2mV(self.bufferBMax, self.ch_range_2, maxADC) -self.bped
-        adc2mVChDMax = adc2mV(self.bufferDMax, self.ch_range_3, maxADC) -self.dped
+            adc2mVChAMax = adc2mV(self.bufferAMax, self.channel_range, maxADC)
+            adc2mVChBMax = adc2mV(self.bufferBMax, self.ch_range_2, maxADC) -self.bped
+            adc2mVChDMax = adc2mV(self.bufferDMax, self.ch_range_3, maxADC) -self.dped
+            return adc2mVChAMax, adc2mVChBMax, adc2mVChDMax 
+
+        return self._analyse_block(self.bufferAMax, self.bufferBMax, self.bufferDMax, maxADC)
+
+    def _rbe_segments(self, give_waves=False, raw_dat=False):
+        """
+            Capture one short segment around each of `n_segments` LED flashes, then pull them all off in one go 
+            The buffers are (segments x samples) arrays, flattened; the waveforms are returned flattened too 
+        """
+        armed = time.time()
+        with self.timer.time("arm"):
+            status = self._ps.ps3000aRunBlock(self.chandle, self.segment_pretrigger, self.totalSamples-self.segment_pretrigger, self._timebase, 1, None, 0, self._ready.arm(), None)
+        assert_pico_ok(status)
+        # with no LED, every segment waits out its auto-trigger
+        self._wait_block(self.ready_timeout + self.n_segments*self.segment_auto_trigger_ms*1e-3)
+        # the scope is live (waiting on triggers) until the last segment fills 
+        self._last_live_time = time.time() - armed
+
+        nsamples = ctypes.c_int32(self.totalSamples)
+        overflow = (ctypes.c_int16 * self.n_segments)()
+        with self.timer.time("transfer"):
+            status = self._ps.ps3000aGetValuesBulk(self.chandle, ctypes.byref(nsamples), 0, self.n_segments-1, 1, self._ps.PS3000A_RATIO_MODE["PS3000A_RATIO_MODE_NONE"], ctypes.byref(overflow))
+        assert_pico_ok(status)
+        self._overflow |= int(np.bitwise_or.reduce(np.ctypeslib.as_array(overflow)))
+
+        maxADC = ctypes.c_int16()
+        status = self._ps.ps3000aMaximumValue(self.chandle, ctypes.byref(maxADC))
+        assert_pico_ok(status)
+        self._last_max_adc = maxADC
+
         if give_waves:
+            if raw_dat:
+                return self.bufferAMax, self.bufferBMax, self.bufferDMax     
+            adc2mVChAMax = adc2mV(self.bufferAMax, self.channel_range, maxADC)
+            adc2mVChBMax = adc2mV(self.bufferBMax, self.ch_range_2, maxADC) -self.bped
+            adc2mVChDMax = adc2mV(self.bufferDMax, self.ch_range_3, maxADC) -self.dped
             return adc2mVChAMax, adc2mVChBMax, adc2mVChDMax 
+        
+        return self._analyse_segments(self.bufferAMax, self.bufferBMax, self.bufferDMax, maxADC)
+
+    def _analyse_segments(self, bufferA, bufferB, bufferD, maxADC):
+        """
+            Same counts as _analyse_block, for segmented captures. Always done in ADC counts 
 
-        time_sample = np.linspace(0, (self.totalSamples - 1) * self.actualSampleIntervalNs, self.totalSamples)
+            Each segment that actually has the LED sync at the trigger point is one trigger. 
+            The hits are found on the flattened buffers, so a hit can only be matched to the trigger in its own segment 
+            (anything from a neighbouring segment is much further away than the coincidence windows)
+        """
+        trig_level, mon_thresh, rec_thresh, mon_ped, rec_ped = self._adc_levels(maxADC)
+        segments = bufferA.reshape(self.n_segments, self.segment_samples)
 
-        t1 = time.time()
-        ctime, trig_bin = get_cfd_time(time_sample, adc2mVChAMax, 1000,auto_adjust_ped=False, use_rise=True)
-        ntrig = len(ctime)
-       
-        nmon = count_hits(trig_bin,adc2mVChBMax, thresh,True,  90, False)
-        nrec = count_hits(trig_bin,adc2mVChDMax, thresh,False, 90, False)
-        mon_bad = count_hits(trig_bin,adc2mVChBMax, thresh,True,  90, True)
-        rec_bad = count_hits(trig_bin,adc2mVChDMax, thresh,False, 90, True)
+        with self.timer.time("crossings"):
+            # if nothing triggered the scope it auto-triggers, and there won't be a sync pulse at the trigger point 
+            sync = segments[:, self.segment_pretrigger:self.segment_pretrigger+4]
+            triggered = np.flatnonzero(np.max(sync, axis=1)>trig_level)
+            # crossings are indexed by the last sample below threshold, so the trigger is just before the trigger point 
+            ctime = triggered*self.segment_samples + self.segment_pretrigger - 1
 
-        return ntrig, nmon, nrec, mon_bad, rec_bad
+        if self.pulse_writer is not None:
+            self._record_pulses(ctime, bufferB, bufferD, mon_thresh, rec_thresh, mon_ped, rec_ped,
+                                (channelInputRanges[self.ch_range_2]/maxADC.value, channelInputRanges[self.ch_range_3]/maxADC.value))
+        return (len(ctime), *count_coincident(ctime, bufferB, bufferD, mon_thresh, rec_thresh, self.actualSampleIntervalNs, mon_ped, rec_ped, self.timing, self.timer))
 
     def _stream(self, give_waves = False, raw_data=False):
+        if self.continuous and not give_waves:
+            return self._stream_continuous()
 
         self.bufferAMax*=0
         self.bufferBMax*=0
@@ -398,16 +1074,12 @@ class PicoMeasure:
 
         # Begin streaming mode:
         
-        sampleUnits = ps.PS3000A_TIME_UNITS['PS3000A_NS']
+        sampleUnits = self._ps.PS3000A_TIME_UNITS['PS3000A_NS']
         # We are not triggering:
         maxPreTriggerSamples = 0
         autoStopOn = 1
         # No downsampling:
         downsampleRatio = 1
-        self.bufferCompleteA = np.zeros(shape=self.totalSamples, dtype=np.int16)
-        self.bufferCompleteB = np.zeros(shape=self.totalSamples, dtype=np.int16)
-        self.bufferCompleteD = np.zeros(shape=self.totalSamples, dtype=np.int16)
-        import time 
         loops = 0
         collection_start = time.time()
         nns = 0
@@ -421,14 +1093,14 @@ class PicoMeasure:
         while True:
             # need to set a lot of this up between calls 
             start = time.time()
-            self.status["runStreaming"] = ps.ps3000aRunStreaming(self.chandle,
+            self.status["runStreaming"] = self._ps.ps3000aRunStreaming(self.chandle,
                                                             ctypes.byref(self.sampleInterval),
                                                             sampleUnits,
                                                             maxPreTriggerSamples,
                                                             self.totalSamples,
                                                             autoStopOn,
                                                             downsampleRatio,
-                                                            ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'],
+                                                            self._ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'],
                                                             self.sizeOfOneBuffer)
             assert_pico_ok(self.status["runStreaming"])
 
@@ -439,9 +1111,9 @@ class PicoMeasure:
             self.nextSample = 0
             self.autoStopOuter = False
             self.wasCalledBack = False
-            # We need a big buffer, not registered with the driver, to keep our complete capture in.
             def streaming_callback(handle, noOfSamples, startIndex, overflow, triggerAt, triggered, autoStop, param):
                 self.wasCalledBack = True
+                self._overflow |= overflow
                 destEnd = self.nextSample + noOfSamples
                 sourceEnd = startIndex + noOfSamples
                 self.bufferCompleteA[self.nextSample:destEnd] = self.bufferAMax[startIndex:sourceEnd]
@@ -453,28 +1125,27 @@ class PicoMeasure:
 
 
             # Convert the python function into a C function pointer.
-            cFuncPtr = ps.StreamingReadyType(streaming_callback)
+            cFuncPtr = self._ps.StreamingReadyType(streaming_callback)
 
             # Fetch data from the driver in a loop, copying it out of the registered buffers and into our complete one.
-            while self.nextSample < self.totalSamples and not self.autoStopOuter:
-                self.wasCalledBack = False
-                self.status["getStreamingLastestValues"] = ps.ps3000aGetStreamingLatestValues(self.chandle, cFuncPtr, None)
-                if not self.wasCalledBack:
-                    # If we weren't called back by the driver, this means no data is ready. Sleep for a short while before trying
-                    # again.
-                    time.sleep(0.01)
+            with self.timer.time("stream"):
+                while self.nextSample < self.totalSamples and not self.autoStopOuter:
+                    self.wasCalledBack = False
+                    self.status["getStreamingLastestValues"] = self._ps.ps3000aGetStreamingLatestValues(self.chandle, cFuncPtr, None)
+                    if not self.wasCalledBack:
+                        # If we weren't called back by the driver, this means no data is ready. Sleep for a short while before trying
+                        # again.
+                        time.sleep(0.01)
             assert_pico_ok(self.status["getStreamingLastestValues"])
 
             # Find maximum ADC count value
             # handle = self.chandle
             # pointer to value = ctypes.byref(maxADC)
             maxADC = ctypes.c_int16()
-            self.status["maximumValue"] = ps.ps3000aMaximumValue(self.chandle, ctypes.byref(maxADC))
+            self.status["maximumValue"] = self._ps.ps3000aMaximumValue(self.chandle, ctypes.byref(maxADC))
             print("Max val", maxADC)
             assert_pico_ok(self.status["maximumValue"])
 
-            # Convert ADC counts data to mV
-            conv_t = time.time()
             if give_waves:
                 if raw_data:
                     return self.bufferCompleteA, self.bufferCompleteB, self.bufferCompleteD
@@ -483,64 +1154,124 @@ class PicoMeasure:
                 adc2mVChDMax = adc2mV(self.bufferCompleteD, self.ch_range_3, maxADC)
                 return adc2mVChAMax, adc2mVChBMax, adc2mVChDMax
 
-            else:
-                adc2mVChAMax = adc2mV(self.bufferCompleteA, self.channel_range, maxADC)
-                adc2mVChBMax = adc2mV(self.bufferCompleteB, self.ch_range_2, maxADC) - self.bped
-                adc2mVChDMax = adc2mV(self.bufferCompleteD, self.ch_range_3, maxADC) - self.dped
-
-
-
-        #    adc2mVChAMax = self.bufferCompleteA
-        #    adc2mVChBMax = self.bufferCompleteB
-        #    adc2mVChDMax = self.bufferCompleteD
-            conv_t_end = time.time()
-            # Create time data
-            time_sample = np.linspace(0, (self.totalSamples - 1) * self.actualSampleIntervalNs, self.totalSamples)
-
-            ctime = get_cfd_time(time_sample, adc2mVChAMax, 1000,auto_adjust_ped=False, use_rise=True)[0]
-            ntrig = len(ctime)
-
-            montime = get_cfd_time(time_sample, -adc2mVChBMax, thresh,auto_adjust_ped= True, use_rise=False)[0]
-            is_good, is_bad = get_valid(ctime, montime, False)
-            nmon = np.sum(is_good)
-            #mon_bad = np.sum(is_bad)*self.mon_lt_good/(1-self.mon_lt_good)
-            mon_bad = np.sum(get_valid(ctime, montime,  False, True))
-        
-            rectime = get_cfd_time(time_sample, -adc2mVChDMax, thresh,auto_adjust_ped= True, use_rise=False)[0]
-            is_good, is_bad = get_valid(ctime, rectime, True)
-            nrec = np.sum(is_good)
-            
-            #rec_bad = np.sum(is_bad)*self.rec_lt_good/(1-self.rec_lt_good)
-            rec_bad = np.sum(get_valid(ctime, rectime, True, True))
+            ntrig, nmon, nrec, mon_bad, rec_bad = self._analyse_block(self.bufferCompleteA, self.bufferCompleteB, self.bufferCompleteD, maxADC)
 
+            self._check_snapshot((ntrig, nmon, nrec, mon_bad, rec_bad), (t_total, mon_total, rec_total, mon_dark, rec_dark), 
+                                 self.bufferCompleteA, self.bufferCompleteB, self.bufferCompleteD, maxADC)
             t_total += ntrig
             mon_total +=nmon 
             rec_total +=nrec 
             mon_dark += mon_bad 
             rec_dark += rec_bad
 
-            if False: #np.abs( 1- (nmon/nrec)/(np.array(mon_total)/np.array(rec_total)))>0.2:
-                print("SPIKE")
-                all_data = {
-                    "time":time_sample,
-                    "chana":adc2mVChAMax,
-                    "chanb":adc2mVChBMax,
-                    "chand":adc2mVChDMax
-                }
-                dfile = h5.File("waveforms.h5", 'w')
-                for key in all_data:
-                    dfile.create_dataset(key, data=all_data[key])
-                dfile.close()
-
             end = time.time()
 
             # the number of those crossing times is the number of pulses! 
                         
-            nns += len(adc2mVChAMax)*8
+            nns += self.totalSamples*8
                 
             loops +=1
-            if (time.time() - collection_start)>self.collection_time:
+            self.timer.end_block(self.totalSamples*self.actualSampleIntervalNs*1e-9)
+            if self._done(collection_start, (t_total, mon_total, rec_total, mon_dark, rec_dark)):
                 break
-                
-        return t_total, mon_total, rec_total, int(mon_dark), int(rec_dark)
+        
+        live = loops*self.totalSamples*self.actualSampleIntervalNs*1e-9
+        dead = (time.time() - collection_start) - live
+        return t_total, mon_total, rec_total, int(mon_dark), int(rec_dark), live, dead
+
+    def _stream_continuous(self):
+        """
+            Stream without ever stopping the scope. 
+            
+            The driver callback copies each new chunk into a ring buffer (the bufferComplete* arrays) and hands it to a worker thread,
+            which looks for triggers and hits in it as it arrives. So there's no gap between captures, 
+            and we're only limited by how fast the driver can get the data over. 
+
+            If the worker falls a full ring behind, new chunks are dropped (and counted as dead time) rather than overwriting ones it hasn't read 
+            This is always done in ADC counts 
+        """
+        maxADC = ctypes.c_int16()
+        self.status["maximumValue"] = self._ps.ps3000aMaximumValue(self.chandle, ctypes.byref(maxADC))
+        assert_pico_ok(self.status["maximumValue"])
+
+        self.status["runStreaming"] = self._ps.ps3000aRunStreaming(self.chandle,
+                                                        ctypes.byref(self.sampleInterval),
+                                                        self._ps.PS3000A_TIME_UNITS['PS3000A_NS'],
+                                                        0,
+                                                        self.totalSamples,
+                                                        0, # no autostop 
+                                                        1,
+                                                        self._ps.PS3000A_RATIO_MODE['PS3000A_RATIO_MODE_NONE'],
+                                                        self.sizeOfOneBuffer)
+        assert_pico_ok(self.status["runStreaming"])
+        self.actualSampleInterval = self.sampleInterval.value
+        self.actualSampleIntervalNs = self.actualSampleInterval *1
+
+        trig_level, mon_thresh, rec_thresh, mon_ped, rec_ped = self._adc_levels(maxADC)
+        counter = StreamCounter(trig_level, mon_thresh, rec_thresh, self.actualSampleIntervalNs, mon_ped, rec_ped)
+        ring = (self.bufferCompleteA, self.bufferCompleteB, self.bufferCompleteD)
+        ring_size = len(self.bufferCompleteA)
+        chunks = queue.Queue()
+
+        # all in samples 
+        self.nextSample = 0
+        self.droppedSamples = 0
+        consumed = [0]
+
+        def consume():
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    return
+                first, n = chunk
+                ring_start = first % ring_size
+                # the chunk might wrap around the end of the ring
+                for start, stop in ((ring_start, min(ring_start+n, ring_size)), (0, max(ring_start+n-ring_size, 0))):
+                    if stop<=start:
+                        continue
+                    with self.timer.time("stream_count"):
+                        counter.add(ring[0][start:stop], ring[1][start:stop], ring[2][start:stop], first)
+                    first += stop-start
+                consumed[0] += n
+                self.timer.end_block(n*self.actualSampleIntervalNs*1e-9)
+
+        def streaming_callback(handle, noOfSamples, startIndex, overflow, triggerAt, triggered, autoStop, param):
+            self.wasCalledBack = True
+            self._overflow |= overflow
+            if self.nextSample + noOfSamples - consumed[0] > ring_size:
+                # don't overwrite what the worker hasn't gotten to yet
+                self.droppedSamples += noOfSamples
+                self.nextSample += noOfSamples
+                return 
+            ring_start = self.nextSample % ring_size
+            copied = 0
+            while copied<noOfSamples:
+                n = min(noOfSamples - copied, ring_size - ring_start)
+                for dest, source in zip(ring, (self.bufferAMax, self.bufferBMax, self.bufferDMax)):
+                    dest[ring_start:ring_start+n] = source[startIndex+copied:startIndex+copied+n]
+                copied += n
+                ring_start = 0
+            chunks.put((self.nextSample, noOfSamples))
+            self.nextSample += noOfSamples
+
+        cFuncPtr = self._ps.StreamingReadyType(streaming_callback)
+        worker = threading.Thread(target=consume)
+        worker.start()
+
+        collection_start = time.time()
+        try:
+            while not self._done(collection_start, counter.counts.copy()):
+                self.wasCalledBack = False
+                self.status["getStreamingLastestValues"] = self._ps.ps3000aGetStreamingLatestValues(self.chandle, cFuncPtr, None)
+                if not self.wasCalledBack:
+                    time.sleep(0.01)
+        finally:
+            self.status["stop"] = self._ps.ps3000aStop(self.chandle)
+            chunks.put(None)
+            worker.join()
+        assert_pico_ok(self.status["stop"])
 
+        live = counter.samples*self.actualSampleIntervalNs*1e-9
+        dead = (time.time() - collection_start) - live
+        t_total, mon_total, rec_total, mon_dark, rec_dark = [int(entry) for entry in counter.counts]
+        return t_total, mon_total, rec_total, mon_dark, rec_dark, live, dead
@@ -0,0 +1,378 @@
+"""
+    A stand-in for the ps3000a driver that plays back recorded captures, or makes up LED pulse trains, instead of talking to a scope
+
+        pico = PicoMeasure(True, backend=ReplayDriver(PoissonSource(mon_mu=1.)))
+
+    PicoMeasure makes the same calls it always does. Buffers get registered, blocks get armed and fetched, streams get polled,
+    and callbacks get called. The samples just come from a source rather than a scope. By default that happens as fast as the source can make them,
+    so the whole analysis chain can be run (and profiled) without any hardware
+
+    Sources hand back the next `n` samples of channels A, B and D as a (3, n) int16 array of ADC counts, from `read(n)`
+"""
+import ctypes
+import threading
+
+import numpy as np
+
+from wms_midas.utilities.utils import MON_WINDOW, REC_WINDOW, channelInputRanges
+
+# what MaximumValue gives back on the 3000 series
+MAX_ADC = 32512
+# channels the sources have samples for, in order
+CHANNELS = (0, 1, 3)
+
+def save_capture(path, bufferA, bufferB, bufferD):
+    """
+        Save one raw capture (like `PicoMeasure.measure(True, True)` gives) where RecordedSource can read it back
+    """
+    np.save(path, np.stack([bufferA, bufferB, bufferD]).astype(np.int16))
+
+class RecordedSource:
+    """
+        Plays back the raw captures in `paths`, one after the other, looping back to the first once they run out
+
+        Each is a (3, n) int16 array of channels A, B, D: a .npy from `save_capture`, or the same in raw binary. They're memory-mapped, so
+        only what's being played back gets read in. `interval_ns` is the sample interval they were taken at
+    """
+    def __init__(self, paths, interval_ns=4., loop=True):
+        if isinstance(paths, str):
+            paths = [paths]
+        self.interval_ns = interval_ns
+        self.loop = loop
+        self._captures = [self._open(path) for path in paths]
+        self._file = 0
+        self._position = 0
+
+    @staticmethod
+    def _open(path):
+        if path.endswith(".npy"):
+            data = np.load(path, mmap_mode="r")
+        else:
+            data = np.memmap(path, dtype=np.int16, mode="r").reshape(3, -1)
+        if data.ndim!=2 or data.shape[0]!=3:
+            raise ValueError("{} isn't a (3, n) capture".format(path))
+        return data
+
+    def configure(self, interval_ns, ranges, max_adc):
+        pass
+
+    def read(self, n):
+        out = np.empty((3, n), dtype=np.int16)
+        filled = 0
+        while filled<n:
+            capture = self._captures[self._file]
+            count = min(n - filled, capture.shape[1] - self._position)
+            out[:, filled:filled+count] = capture[:, self._position:self._position+count]
+            filled += count
+            self._position += count
+            if self._position==capture.shape[1]:
+                self._position = 0
+                self._file += 1
+                if self._file==len(self._captures):
+                    if not self.loop:
+                        raise EOFError("Ran out of recorded captures")
+                    self._file = 0
+        return out
+
+class PoissonSource:
+    """
+        Makes up captures: an LED sync pulse on A every `period_ns`, and pulses on the monitor (B) and receiver (D) after it
+
+        Each flash gives a Poisson number of photoelectrons on the monitor and receiver (means `mon_mu` and `rec_mu`), each one `pe_mV` high
+        (with a `pe_spread` relative spread). They land `mon_delay` and `rec_delay` ns after the sync, inside the coincidence windows.
+        On top of that there's dark noise, single photoelectrons at `dark_rate` Hz on each channel, and Gaussian noise of `noise_mV` rms
+    """
+    def __init__(self, period_ns=1480., mon_mu=1., rec_mu=0.1, pe_mV=30., pe_spread=0.3, dark_rate=1e3, noise_mV=0.5,
+                 sync_mV=1500., sync_ns=20., pulse_ns=8., mon_delay=MON_WINDOW[0]+8, rec_delay=REC_WINDOW[0]+6, seed=None):
+        self.interval_ns = None
+        self.period_ns = period_ns
+        self.mon_mu = mon_mu
+        self.rec_mu = rec_mu
+        self.pe_mV = pe_mV
+        self.pe_spread = pe_spread
+        self.dark_rate = dark_rate
+        self.noise_mV = noise_mV
+        self.sync_mV = sync_mV
+        self.sync_ns = sync_ns
+        self.pulse_ns = pulse_ns
+        self.mon_delay = mon_delay
+        self.rec_delay = rec_delay
+        self._rng = np.random.default_rng(seed)
+        self._configured = None
+        # samples so far, and the tails of pulses that ran off the end of the last read
+        self._time = 0
+        self._carry = None
+
+    def configure(self, interval_ns, ranges, max_adc):
+        """
+            Called by the driver whenever a capture starts. `ranges` are the full scales [mV] of A, B, D
+        """
+        if self._configured==(interval_ns, tuple(ranges), max_adc):
+            return
+        self._configured = (interval_ns, tuple(ranges), max_adc)
+        self._dt = interval_ns
+        self._scale = np.array([max_adc/rang for rang in ranges])
+        self._sync = np.ones(max(int(round(self.sync_ns/interval_ns)), 1))
+        self._pulse = -np.ones(max(int(round(self.pulse_ns/interval_ns)), 1))
+        self._tail = max(len(self._sync), len(self._pulse)) + int(np.ceil(self.rec_delay/interval_ns)) + 1
+        self._carry = np.zeros((3, self._tail))
+        # a bank of noise to take slices out of, far cheaper than drawing new noise for every sample
+        self._noise = self._rng.normal(0, self.noise_mV, (3, 1<<20))
+
+    def _add(self, out, channel, positions, heights, shape):
+        if len(positions)==0:
+            return
+        index = (positions[:, None] + np.arange(len(shape))).ravel()
+        np.add.at(out[channel], index, (heights[:, None]*shape).ravel())
+
+    def read(self, n, piece=1<<20):
+        if self._configured is None:
+            raise RuntimeError("Source hasn't been configured, start a capture first")
+        # made a piece at a time, so the float scratch space stays small however long the capture is
+        out = np.empty((3, n), dtype=np.int16)
+        for start in range(0, n, piece):
+            out[:, start:start+piece] = self._read(min(piece, n-start))
+        return out
+
+    def _read(self, n):
+        out = np.zeros((3, n+self._tail))
+        out[:, :self._tail] += self._carry
+
+        # flashes that start in this read. Their pulses can spill into the tail
+        period = self.period_ns/self._dt
+        first = int(np.ceil(self._time/period))
+        last = int(np.ceil((self._time+n)/period))
+        flashes = np.round(np.arange(first, last)*period).astype(np.int64) - self._time
+        flashes = flashes[flashes<n]
+        self._add(out, 0, flashes, np.full(len(flashes), self.sync_mV), self._sync)
+        for channel, mu, delay in ((1, self.mon_mu, self.mon_delay), (2, self.rec_mu, self.rec_delay)):
+            npe = self._rng.poisson(mu, len(flashes))
+            hit = npe>0
+            heights = npe[hit]*self.pe_mV*(1 + self.pe_spread*self._rng.standard_normal(np.count_nonzero(hit))/np.sqrt(npe[hit]))
+            self._add(out, channel, flashes[hit] + int(round(delay/self._dt)), heights, self._pulse)
+
+            ndark = self._rng.poisson(self.dark_rate*n*self._dt*1e-9)
+            self._add(out, channel, self._rng.integers(0, n, ndark), np.full(ndark, self.pe_mV), self._pulse)
+
+        self._carry = out[:, n:].copy()
+        self._time += n
+
+        samples = out[:, :n]
+        start = self._rng.integers(0, self._noise.shape[1])
+        filled = 0
+        while filled<n:
+            count = min(n - filled, self._noise.shape[1] - start)
+            samples[:, filled:filled+count] += self._noise[:, start:start+count]
+            filled += count
+            start = 0
+        samples *= self._scale[:, None]
+        return np.clip(np.round(samples), -MAX_ADC, MAX_ADC).astype(np.int16)
+
+def _target(arg):
+    """
+        What a ctypes.byref() points at
+    """
+    return arg._obj if hasattr(arg, "_obj") else arg
+
+class ReplayDriver:
+    """
+        Takes the place of picosdk's `ps3000a` (and the enums PicoMeasure uses), feeding captures from `source`
+
+        `interval_ns` is the block-mode sample interval, unless the source has its own. If `realtime`, blocks are only ready after
+        as long as the real scope would take to capture them, otherwise straight away
+    """
+    PS3000A_CHANNEL = {"PS3000A_CHANNEL_A":0, "PS3000A_CHANNEL_B":1, "PS3000A_CHANNEL_C":2, "PS3000A_CHANNEL_D":3, "PS3000A_EXTERNAL":4}
+    PS3000A_COUPLING = {"PS3000A_AC":0, "PS3000A_DC":1}
+    PS3000A_RANGE = {"PS3000A_{}".format(name):i for i, name in enumerate(["10MV", "20MV", "50MV", "100MV", "200MV", "500MV", "1V", "2V", "5V", "10V", "20V", "50V"])}
+    PS3000A_RATIO_MODE = {"PS3000A_RATIO_MODE_NONE":0, "PS3000A_RATIO_MODE_AGGREGATE":1, "PS3000A_RATIO_MODE_DECIMATE":2, "PS3000A_RATIO_MODE_AVERAGE":4}
+    PS3000A_TIME_UNITS = {"PS3000A_FS":0, "PS3000A_PS":1, "PS3000A_NS":2, "PS3000A_US":3, "PS3000A_MS":4, "PS3000A_S":5}
+    PICO_BANDWIDTH_LIMITER = {"PICO_BW_FULL":0, "PICO_BW_20MHZ":1}
+
+    # the callbacks are just called from python, there's no C function pointer to make
+    BlockReadyType = staticmethod(lambda callback: callback)
+    StreamingReadyType = staticmethod(lambda callback: callback)
+
+    def __init__(self, source, interval_ns=4., memory_samples=1<<27, stream_chunk=1<<20, realtime=False):
+        self.source = source
+        self.interval_ns = interval_ns if getattr(source, "interval_ns", None) is None else source.interval_ns
+        self.memory_samples = memory_samples
+        self.stream_chunk = stream_chunk
+        self.realtime = realtime
+
+        self._ranges = {channel:7 for channel in range(4)}
+        # (channel, segment): registered buffer
+        self._buffers = {}
+        self._segments = 1
+        self._captures = 1
+        self._trigger = None
+        self._block = None
+        self._stream = None
+        # samples read from the source but not used yet
+        self._pending = np.zeros((3, 0), dtype=np.int16)
+
+    def _configure_source(self, interval_ns):
+        self.source.configure(interval_ns, [channelInputRanges[self._ranges[channel]] for channel in CHANNELS], MAX_ADC)
+
+    def _take(self, n):
+        if self._pending.shape[1]<n:
+            self._pending = np.concatenate([self._pending, self.source.read(n - self._pending.shape[1])], axis=1)
+        out = self._pending[:, :n]
+        self._pending = self._pending[:, n:]
+        return out
+
+    def _untake(self, data):
+        self._pending = np.concatenate([data, self._pending], axis=1)
+
+    def _register(self, channel, pointer, length, segment):
+        address = pointer if isinstance(pointer, int) else ctypes.cast(pointer, ctypes.c_void_p).value
+        self._buffers[(channel, segment)] = np.ctypeslib.as_array((ctypes.c_int16*length).from_address(address))
+        return 0
+
+    def _fill(self, segment, data, start=0):
+        for channel, samples in zip(CHANNELS, data):
+            if (channel, segment) in self._buffers:
+                self._buffers[(channel, segment)][start:start+samples.shape[0]] = samples
+
+    # unit setup
+    def ps3000aOpenUnit(self, handle, serial):
+        _target(handle).value = 1
+        return 0
+
+    def ps3000aChangePowerSource(self, handle, status):
+        return 0
+
+    def ps3000aSetChannel(self, handle, channel, enabled, coupling, rang, offset):
+        self._ranges[channel] = rang
+        return 0
+
+    def ps3000aSetBandwidthFilter(self, handle, channel, bandwidth):
+        return 0
+
+    def ps3000aGetChannelInformation(self, *args):
+        return 0
+
+    def ps3000aMaximumValue(self, handle, value):
+        _target(value).value = MAX_ADC
+        return 0
+
+    def ps3000aSetDataBuffers(self, handle, channel, buffer_max, buffer_min, length, segment, mode):
+        return self._register(channel, buffer_max, length, segment)
+
+    def ps3000aSetDataBuffer(self, handle, channel, buffer, length, segment, mode):
+        return self._register(channel, buffer, length, segment)
+
+    def ps3000aGetTimebase2(self, handle, timebase, samples, interval, oversample, max_samples, segment):
+        _target(interval).value = self.interval_ns
+        _target(max_samples).value = self.memory_samples//self._segments
+        return 0
+
+    def ps3000aMemorySegments(self, handle, segments, max_samples):
+        self._segments = segments
+        _target(max_samples).value = self.memory_samples//segments
+        return 0
+
+    def ps3000aSetNoOfCaptures(self, handle, captures):
+        self._captures = captures
+        return 0
+
+    def ps3000aSetSimpleTrigger(self, handle, enable, source, threshold, direction, delay, auto_trigger_ms):
+        self._trigger = (source, threshold, auto_trigger_ms) if enable else None
+        return 0
+
+    # block mode
+    def ps3000aRunBlock(self, handle, pre_trigger, post_trigger, timebase, oversample, time_indisposed, segment, ready, parameter):
+        self._configure_source(self.interval_ns)
+        self._block = (pre_trigger, pre_trigger+post_trigger)
+        if self.realtime:
+            capture = self._captures*self._block[1]*self.interval_ns*1e-9
+            if ready is not None:
+                threading.Timer(capture, ready, (handle, 0, None)).start()
+        elif ready is not None:
+            ready(handle, 0, None)
+        return 0
+
+    def _triggered_segments(self, count, pre_trigger, total):
+        """
+            The next `count` captures of `total` samples, each with the sync rising past the trigger level at `pre_trigger`
+            Like the scope, it auto-triggers wherever it is once it's gone `auto_trigger_ms` without a sync
+        """
+        source, level, auto_trigger_ms = self._trigger
+        row = CHANNELS.index(source)
+        auto = int(auto_trigger_ms*1e6/self.interval_ns) if auto_trigger_ms else None
+        segments = np.empty((count, 3, total), dtype=np.int16)
+        found = 0
+        # samples gone by since the last capture, carried over from one chunk to the next
+        idle = 0
+        while found<count:
+            data = self._take(max(self.stream_chunk, 2*total))
+            n = data.shape[1]
+            over = data[row]>level
+            rising = np.flatnonzero(~over[:-1] & over[1:]) + 1 - pre_trigger
+            rising = rising[rising>=0]
+            pos = 0
+            while found<count:
+                following = rising[np.searchsorted(rising, pos):]
+                trigger = following[0] if len(following)!=0 else None
+                deadline = pos + max(auto - idle, 0) if auto is not None else None
+                if trigger is not None and (deadline is None or trigger<=deadline):
+                    start = trigger
+                elif deadline is not None:
+                    start = deadline
+                else:
+                    break
+                if start+total>n:
+                    break
+                segments[found] = data[:, start:start+total]
+                found += 1
+                pos = start+total
+                idle = 0
+            # anything that might still hold a whole capture goes back for next time
+            keep = max(pos, n-total)
+            idle += keep - pos
+            self._untake(data[:, keep:])
+        return segments
+
+    def ps3000aGetValuesBulk(self, handle, samples, first, last, downsample, mode, overflow):
+        pre_trigger, total = self._block
+        count = last - first + 1
+        if self._trigger is None:
+            segments = [self._take(total) for _ in range(count)]
+        else:
+            segments = self._triggered_segments(count, pre_trigger, total)
+        for segment, data in zip(range(first, last+1), segments):
+            self._fill(segment, data)
+        _target(samples).value = total
+        flags = _target(overflow)
+        for i in range(len(flags)):
+            flags[i] = 0
+        return 0
+
+    # streaming
+    def ps3000aRunStreaming(self, handle, interval, units, pre_trigger, post_trigger, auto_stop, downsample, mode, buffer_size):
+        if units!=self.PS3000A_TIME_UNITS["PS3000A_NS"]:
+            raise ValueError("Only replaying at intervals in ns")
+        if getattr(self.source, "interval_ns", None) is not None:
+            _target(interval).value = int(self.source.interval_ns)
+        self._configure_source(_target(interval).value)
+        self._stream = {"remaining":pre_trigger+post_trigger if auto_stop else None, "buffer":buffer_size}
+        return 0
+
+    def ps3000aGetStreamingLatestValues(self, handle, callback, parameter):
+        stream = self._stream
+        if stream is None or stream["remaining"]==0:
+            return 0
+        n = min(self.stream_chunk, stream["buffer"])
+        if stream["remaining"] is not None:
+            n = min(n, stream["remaining"])
+            stream["remaining"] -= n
+        self._fill(0, self._take(n))
+        callback(handle, n, 0, 0, 0, 0, int(stream["remaining"]==0), parameter)
+        return 0
+
+    def ps3000aStop(self, handle):
+        self._stream = None
+        return 0
+
+    def ps3000aCloseUnit(self, handle):
+        self._buffers = {}
+        return 0
@@ -0,0 +1,189 @@
+"""
+    Runs a scan over stage positions, LEDs, and LED ADC values, measuring with the PicoScope at every point
+
+    The hardware is slow to change: setting the ADC takes ~1.25 s (LEDBoard.set_adc sends five characters, 0.25 s apart) and
+    a stage move blocks for at least a second. So the grid is walked in whichever nested order changes the expensive settings least,
+    snaking back and forth so only one setting changes between points.
+    And the hardware moves on to the next point while the last blocks of the previous point are still being analysed.
+
+    Each point gets one record (its configuration and counts), written out as a line of JSON as soon as it's done
+"""
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import Future
+
+from wms_midas.utilities.read_pico import ratio_precision
+
+# the settings of a point, in the order they're stored
+KEYS = ("stage", "led", "adc")
+
+# seconds to change each setting
+TRANSITION_COST = {
+    "stage":1.,
+    "led":0.05,
+    "adc":1.25,
+}
+
+def transition_time(last, point, costs=TRANSITION_COST):
+    """
+        Seconds to go from configuration `last` to `point` (dicts of the settings). `last` can be None, where everything needs setting
+    """
+    return sum(costs[key] for key in KEYS if last is None or last[key]!=point[key])
+
+def scan_time(points, costs=TRANSITION_COST):
+    """
+        Total seconds spent changing settings over the whole scan
+    """
+    total = 0
+    last = None
+    for point in points:
+        total += transition_time(last, point, costs)
+        last = point
+    return total
+
+def snake(values):
+    """
+        Every combination of the lists in `values`, with the first list the outermost loop.
+        Each inner loop runs backwards every other time through, so only one setting changes from one point to the next
+    """
+    if len(values)==1:
+        return [(value,) for value in values[0]]
+    inner = snake(values[1:])
+    points = []
+    for i, value in enumerate(values[0]):
+        points += [(value,)+rest for rest in (inner if i%2==0 else inner[::-1])]
+    return points
+
+def order_grid(stages, leds, adcs, costs=TRANSITION_COST):
+    """
+        The points of the stages x leds x adcs grid, in the order that spends the least time changing settings
+        Tries every nesting of the three loops (each snaked), and keeps the cheapest
+    """
+    axes = {"stage":list(stages), "led":list(leds), "adc":list(adcs)}
+    best = None
+    for nesting in itertools.permutations(KEYS):
+        points = [dict(zip(nesting, entry)) for entry in snake([axes[key] for key in nesting])]
+        cost = scan_time(points, costs)
+        if best is None or cost<best[0]:
+            best = (cost, points)
+    return best[1]
+
+class DirectHardware:
+    """
+        Sets up a point by talking to the LED board and the stage directly. The stage moves while the board is set up
+        The board calls stay on this thread, one after the other, since they share its serial port
+    """
+    def __init__(self, board, stage):
+        self.board = board
+        self.stage = stage
+
+    def apply(self, point, last=None):
+        move = None
+        if last is None or last["stage"]!=point["stage"]:
+            move = threading.Thread(target=self.stage.move_absolute, args=(point["stage"],))
+            move.start()
+        if last is None or last["adc"]!=point["adc"]:
+            self.board.set_adc(int(point["adc"]))
+        if last is None or last["led"]!=point["led"]:
+            self.board.activate_led(int(point["led"]))
+        if move is not None:
+            move.join()
+
+class ODBHardware:
+    """
+        Sets up a point through the ODB, and waits for the stage and LED frontends to report they're there
+    """
+    settings = {
+        "stage":"/Equipment/ELLXStage/Settings/dest",
+        "adc":"/Equipment/LEDBoard/Settings/ADC",
+        "led":"/Equipment/LEDBoard/Settings/LED",
+    }
+
+    # feStage writes back where the stage actually got to, which is only good to an encoder pulse
+    tolerance = {"stage":1/1024, "adc":0, "led":0}
+
+    def __init__(self, client, timeout=30., poll=0.05):
+        self.client = client
+        self.timeout = timeout
+        self.poll = poll
+
+    def apply(self, point, last=None):
+        changed = [key for key in KEYS if last is None or last[key]!=point[key]]
+        for key in changed:
+            self.client.odb_set(self.settings[key], point[key])
+
+        # the frontends copy each setting over to Variables once the hardware has it
+        start = time.time()
+        for key in changed:
+            path = self.settings[key].replace("Settings", "Variables")
+            while abs(self.client.odb_get(path) - point[key])>self.tolerance[key]:
+                if (time.time() - start)>self.timeout:
+                    raise TimeoutError("{} didn't reach {} after {} s".format(path, point[key], self.timeout))
+                time.sleep(self.poll)
+
+class Scan:
+    """
+        Measures at every point of the stages x leds x adcs grid
+        `pico` is a PicoMeasure (or anything with a `measure`), and `hardware` something with an `apply(point, last)` like DirectHardware or ODBHardware
+
+        Records go to `out_path` (one JSON object per line) if given, and are kept in `records`
+    """
+    def __init__(self, pico, hardware, stages, leds, adcs, out_path=None, costs=TRANSITION_COST):
+        self.pico = pico
+        self.hardware = hardware
+        self.points = order_grid(stages, leds, adcs, costs)
+        self.out_path = out_path
+        self.costs = costs
+        self.records = []
+
+    def estimate(self):
+        """
+            Seconds the scan should take: the collection time at every point, plus changing the settings
+        """
+        return len(self.points)*self.pico.collection_time + scan_time(self.points, self.costs)
+
+    def _measure(self):
+        if hasattr(self.pico, "measure_async"):
+            return self.pico.measure_async()
+        future = Future()
+        future.set_result(self.pico.measure())
+        return future
+
+    def _record(self, point, start, end, future):
+        trig, mon, rec, mond, recd, live, dead = future.result()
+        record = {key:point[key] for key in KEYS}
+        record.update({
+            "start":start,
+            "end":end,
+            "trig":int(trig),
+            "mon":int(mon),
+            "rec":int(rec),
+            "mon_dark":int(mond),
+            "rec_dark":int(recd),
+            "live":float(live),
+            "dead":float(dead),
+            "precision":ratio_precision(mon, rec, mond, recd),
+        })
+        self.records.append(record)
+        if self.out_path is not None:
+            with open(self.out_path, 'at') as _obj:
+                _obj.write(json.dumps(record)+"\n")
+        return record
+
+    def run(self):
+        last = None
+        pending = None
+        for point in self.points:
+            # the last point's analysis finishes up while the hardware moves
+            self.hardware.apply(point, last)
+            if pending is not None:
+                self._record(*pending)
+            last = point
+            start = time.time()
+            future = self._measure()
+            pending = (point, start, time.time(), future)
+        if pending is not None:
+            self._record(*pending)
+        return self.records
@@ -0,0 +1,236 @@
+"""
+    Writing the analysis out to disk, somewhere between the five counts per measurement and the full waveforms
+
+    Pulse records (see utils.PULSE_DTYPE) go into one chunked, compressed HDF5 table. There's one per trigger, so changing
+    the windows or thresholds later means re-histogramming a table rather than re-acquiring
+
+    Raw captures only get kept when something looks off (see SnapshotWriter), and are written on their own thread
+"""
+import glob
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from wms_midas.utilities.lazy import LazyModule
+from wms_midas.utilities.utils import PULSE_DTYPE
+
+h5py = LazyModule("h5py")
+
+class PulseRecordWriter:
+    """
+        Appends pulse records to the `pulses` table of an HDF5 file
+        Records are held onto until there's a whole chunk's worth, then go out in one write. `attrs` get stored on the table
+
+        Safe to call `append` from the analysis thread while something else calls `flush`
+    """
+    def __init__(self, path, chunk=1<<16, compression="gzip", compression_opts=4, attrs=None, mode="a", name="pulses"):
+        self.path = path
+        self.chunk = chunk
+        self._lock = threading.Lock()
+        self._pending = []
+        self._n_pending = 0
+
+        self._file = h5py.File(path, mode)
+        if name in self._file:
+            self._table = self._file[name]
+            if self._table.dtype!=PULSE_DTYPE:
+                raise ValueError("{} in {} doesn't hold pulse records".format(name, path))
+        else:
+            self._table = self._file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=PULSE_DTYPE,
+                                                    chunks=(chunk,), compression=compression, compression_opts=compression_opts, shuffle=True)
+        for key, value in (attrs or {}).items():
+            self._table.attrs[key] = value
+
+    def __len__(self):
+        return len(self._table) + self._n_pending
+
+    def append(self, records):
+        with self._lock:
+            if len(records)!=0:
+                self._pending.append(np.asarray(records, dtype=PULSE_DTYPE))
+                self._n_pending += len(records)
+            if self._n_pending>=self.chunk:
+                self._write()
+
+    def _write(self):
+        if self._n_pending==0:
+            return
+        records = np.concatenate(self._pending)
+        start = len(self._table)
+        self._table.resize((start+len(records),))
+        self._table[start:] = records
+        self._pending = []
+        self._n_pending = 0
+
+    def flush(self):
+        with self._lock:
+            self._write()
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._write()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_pulses(path, name="pulses"):
+    """
+        All the pulse records in `path`, and the attributes stored with them
+    """
+    with h5py.File(path, "r") as _obj:
+        return _obj[name][:], dict(_obj[name].attrs)
+
+def ratio_anomaly(counts, totals, tolerance=0.2, min_hits=20):
+    """
+        Whether the mon/rec ratio of one block (`counts`: triggers, mon, rec, ...) is more than `tolerance` (relative) off of
+        the ratio in the `totals` so far. Needs `min_hits` on both channels in the block and the totals, or it's just noise
+    """
+    mon, rec = counts[1], counts[2]
+    mon_total, rec_total = totals[1], totals[2]
+    if min(mon, rec, mon_total, rec_total)<min_hits:
+        return False
+    return abs(1 - (mon/rec)/(mon_total/rec_total))>tolerance
+
+class SnapshotWriter:
+    """
+        Writes raw (int16) captures to HDF5 on a background thread, so acquisition never waits on the disk 
+
+        `submit` copies the capture and hands it over through a queue of at most `max_queue` snapshots. If that's full, the snapshot 
+        is dropped (and counted in `dropped`) rather than waiting. Each snapshot is a group of chunked, compressed datasets, one per channel, 
+        with whatever's needed to convert back to mV stored as attributes
+
+        Files are named `prefix_NNNN.h5` in `directory`. A new one is started once the current one passes `file_bytes`, 
+        and the oldest ones are deleted to keep the total under `max_bytes`
+
+        A snapshot that fails to write is counted in `failed` (the error is kept in `last_error`), and the next one goes to a new file
+    """
+    def __init__(self, directory, prefix="snapshot", max_queue=4, file_bytes=256<<20, max_bytes=4<<30, chunk=1<<16, compression="gzip", compression_opts=4):
+        self.directory = directory
+        self.prefix = prefix
+        self.file_bytes = file_bytes
+        self.max_bytes = max_bytes
+        self.chunk = chunk
+        self.compression = compression
+        self.compression_opts = compression_opts
+
+        self.written = 0
+        self.dropped = 0
+        self.deleted = 0
+        self.failed = 0
+        self.last_error = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._files = sorted(glob.glob(os.path.join(directory, "{}_*.h5".format(prefix))))
+        self._index = 0
+        if len(self._files)!=0:
+            self._index = int(os.path.splitext(self._files[-1])[0].rsplit("_", 1)[1]) + 1
+        self._file = None
+
+        self._queue = queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def submit(self, channels, attrs=None):
+        """
+            Queue up a snapshot. `channels` is a dict of name: raw capture, `attrs` is stored alongside (ranges, maxADC, interval...)
+            Returns whether it was queued 
+        """
+        if self._thread is None:
+            return False
+        # don't bother copying something that's just going to be dropped
+        if self._queue.full():
+            self.dropped += 1
+            return False
+        try:
+            self._queue.put_nowait(({name:np.array(data, dtype=np.int16) for name, data in channels.items()}, dict(attrs or {}), time.time()))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _work(self):
+        while True:
+            snapshot = self._queue.get()
+            if snapshot is None:
+                return
+            try:
+                self._write(*snapshot)
+            except Exception as e:
+                self.failed += 1
+                self.last_error = e
+                # whatever state the file is in, don't write anything more to it
+                if self._file is not None:
+                    try:
+                        self._file.close()
+                    except Exception:
+                        pass
+                    self._file = None
+
+    def _open(self):
+        path = os.path.join(self.directory, "{}_{:04d}.h5".format(self.prefix, self._index))
+        self._index += 1
+        self._files.append(path)
+        self._file = h5py.File(path, "w")
+
+    def _write(self, channels, attrs, when):
+        if self._file is None:
+            self._open()
+        group = self._file.create_group("snapshot_{:06d}".format(self.written))
+        group.attrs["time"] = when
+        for key, value in attrs.items():
+            group.attrs[key] = value
+        for name, data in channels.items():
+            group.create_dataset(name, data=data, chunks=(min(self.chunk, max(len(data), 1)),), 
+                                 compression=self.compression, compression_opts=self.compression_opts, shuffle=True)
+        self._file.flush()
+        self.written += 1
+
+        if os.path.getsize(self._files[-1])>=self.file_bytes:
+            self._file.close()
+            self._file = None
+        self._trim()
+
+    def _trim(self):
+        """
+            Delete the oldest files until we're under the disk cap. The one being written to is never deleted
+        """
+        closed = list(self._files if self._file is None else self._files[:-1])
+        total = sum(os.path.getsize(path) for path in self._files)
+        while total>self.max_bytes and len(closed)!=0:
+            path = closed.pop(0)
+            total -= os.path.getsize(path)
+            os.remove(path)
+            self._files.remove(path)
+            self.deleted += 1
+
+    def close(self, timeout=60.):
+        """
+            Write out whatever's still queued, and close the file
+            Gives up after `timeout` seconds if the writer thread is stuck, leaving the file to it. Returns whether it finished
+        """
+        if self._thread is None:
+            return True
+        thread, self._thread = self._thread, None
+        if thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            thread.join(timeout)
+        if thread.is_alive():
+            return False
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return True
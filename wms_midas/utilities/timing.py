@@ -0,0 +1,102 @@
+"""
+    Timers for the stages of an acquisition (arming, waiting on the scope, transfer, analysis...)
+
+    Each block's stage times go into one row of a fixed-size ring, so keeping them costs the same no matter how long we run.
+    When timing is off, everything goes through NullTimer, which doesn't even read the clock
+"""
+from contextlib import contextmanager, nullcontext
+import time
+
+import numpy as np
+
+_nothing = nullcontext()
+
+class NullTimer:
+    """
+        Stands in for a StageTimer when timing is off
+    """
+    enabled = False
+
+    def time(self, stage):
+        return _nothing
+
+    def add(self, stage, seconds):
+        pass
+
+    def end_block(self, live):
+        pass
+
+    def summary(self, percentiles=(50, 90, 99)):
+        return None
+
+NULL_TIMER = NullTimer()
+
+class StageTimer:
+    """
+        Keeps the time spent in each of `stages` for the last `size` blocks, along with each block's live and wall-clock time
+
+        Wrap each stage in `with timer.time(stage):` and call `end_block(live)` once a block is done.
+        Stages that run on another thread (pipelined analysis) land in whichever block is open when they finish
+    """
+    enabled = True
+
+    def __init__(self, stages, size=1024):
+        self.stages = tuple(stages)
+        self.size = size
+        self._column = {stage:i for i, stage in enumerate(self.stages)}
+        self._times = np.zeros((size, len(self.stages)))
+        self._live = np.zeros(size)
+        self._wall = np.zeros(size)
+        self.blocks = 0
+        self._block_start = time.perf_counter()
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        self._times[self.blocks%self.size, self._column[stage]] += seconds
+
+    def end_block(self, live):
+        now = time.perf_counter()
+        row = self.blocks%self.size
+        self._live[row] = live
+        self._wall[row] = now - self._block_start
+        self._block_start = now
+        self.blocks += 1
+        self._times[self.blocks%self.size] = 0
+
+    def reset(self):
+        self._times[:] = 0
+        self._live[:] = 0
+        self._wall[:] = 0
+        self.blocks = 0
+        self._block_start = time.perf_counter()
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """
+            Per stage: the mean and percentiles of its time per block [s], and its share of the wall-clock time.
+            Plus the live fraction, all over the blocks still in the ring
+        """
+        n = min(self.blocks, self.size)
+        if n==0:
+            return {"blocks":0, "live_fraction":np.nan, "stages":{}}
+        rows = np.arange(self.blocks - n, self.blocks)%self.size
+        times = self._times[rows]
+        wall = np.sum(self._wall[rows])
+
+        stages = {}
+        for stage, column in self._column.items():
+            entry = {"mean":float(np.mean(times[:, column])), "fraction":float(np.sum(times[:, column])/wall) if wall>0 else np.nan}
+            for percentile, value in zip(percentiles, np.percentile(times[:, column], percentiles)):
+                entry["p{}".format(percentile)] = float(value)
+            stages[stage] = entry
+        return {
+            "blocks":n,
+            "live_fraction":float(np.sum(self._live[rows])/wall) if wall>0 else np.nan,
+            "stages":stages,
+        }
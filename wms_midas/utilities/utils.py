@@ -1,16 +1,28 @@
 import ctypes
-from multiprocessing.sharedctypes import Value
-from picosdk.ps3000a import ps3000a as ps
-from picosdk.functions import adc2mV, assert_pico_ok, mV2adc
+import mmap
 from contextlib import ContextDecorator # used to trigger the compilation
 
 from enum import Enum
-import matplotlib.pyplot as plt 
 
 import numpy as np 
-import time as pytime
-from scipy.signal import find_peaks
-from tqdm import tqdm
+import threading
+
+from wms_midas.utilities.lazy import LazyModule
+from wms_midas.utilities.timing import NULL_TIMER
+
+# the driver bindings load the ps3000a library, so they're only imported once something actually talks to the scope
+ps = LazyModule("picosdk.ps3000a", "ps3000a")
+_pico_functions = LazyModule("picosdk.functions")
+
+# the driver's status for "everything's fine"
+PICO_OK = 0
+
+def assert_pico_ok(status):
+    # only bring in picosdk when there's an error to raise, so stand-in drivers (see replay.py) don't need it
+    if status==PICO_OK:
+        return
+    return _pico_functions.assert_pico_ok(status)
+
 MAXSAMPLES = 25000
 overflow = (ctypes.c_int16 * 60)()
 cmaxSamples = ctypes.c_int32(MAXSAMPLES)
@@ -20,65 +32,534 @@ chARange = 5
 nbuf = 10
 channelInputRanges = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000]
 
-def get_cfd_time(times, signal, threshold, auto_adjust_ped = False, use_rise=False):
-    if auto_adjust_ped:
-        ped = np.mean( signal[np.abs(signal)<0.66*threshold] )
-    else:
-        ped = 0
-    crossings = np.diff(np.sign((signal-ped) - threshold))
-    if use_rise:
-        crossings[crossings<0] = 0    
-    else:
-        crossings[crossings>0] = 0
-    
-    crossings = np.where(crossings)
-    x0 = times[crossings[0]]
-    return x0, x0
+# samples per chunk when looking for crossings. 64k int16 samples sits comfortably in L2
+CHUNK_SAMPLES = 1<<16
+
+class CrossingFinder:
+    """
+        Walks along a waveform in cache-sized chunks looking for threshold crossings
+        The scratch space is allocated once here, so finding crossings doesn't allocate anything that grows with the capture length 
+        (besides the crossings themselves)
+    """
+    def __init__(self, chunk=CHUNK_SAMPLES):
+        self.chunk = chunk
+        self._over = np.empty(chunk+1, dtype=bool)
+        self._edge = np.empty(chunk, dtype=bool)
+        self._near = np.empty(chunk, dtype=bool)
+        self._scratch = np.empty(chunk, dtype=bool)
+
+    def pedestal(self, signal, ped, window):
+        """
+            Mean of the samples within `window` of `ped`
+        """
+        total, count = self.pedestal_sums(signal, ped, window)
+        if count==0:
+            return ped
+        return total/count
+
+    def pedestal_sums(self, signal, ped, window):
+        """
+            The sum and number of samples within `window` of `ped`, so a pedestal can be built up over several chunks 
+        """
+        total = 0.
+        count = 0
+        for start in range(0, len(signal), self.chunk):
+            part = signal[start:start+self.chunk]
+            near = self._near[:len(part)]
+            scratch = self._scratch[:len(part)]
+            np.greater(part, ped-window, out=near)
+            np.less(part, ped+window, out=scratch)
+            np.logical_and(near, scratch, out=near)
+            count += np.count_nonzero(near)
+            total += np.sum(part, where=near, dtype=np.float64)
+        return total, count
+
+    def crossings(self, signal, level, negative=False, use_rise=False, previous=None):
+        """
+            Returns the (int64) indices `i` where the signal crosses `level` between samples i and i+1 
 
-    y0 = signal[crossings[0]]
-    y1 = signal[crossings[0]+1]
-    slope = (y1-y0)/8
-    b = y0 - slope*x0 
-    return (threshold - b)/slope, (threshold - b)/slope -x0
+            `previous` is the sample just before this signal (ie, the end of the last chunk of a stream). 
+            A crossing between it and the first sample is returned as index -1
+        """
+        found = []
+        if previous is not None and len(signal)!=0:
+            if negative:
+                before, after = previous<level, signal[0]<level
+            else:
+                before, after = previous>level, signal[0]>level
+            if (after and not before) if use_rise else (before and not after):
+                found.append(np.array([-1], dtype=np.int64))
+
+        for start in range(0, len(signal)-1, self.chunk):
+            # one sample of overlap with the next chunk, so we catch crossings on the boundary 
+            part = signal[start:start+self.chunk+1]
+            over = self._over[:len(part)]
+            edge = self._edge[:len(part)-1]
+            if negative:
+                np.less(part, level, out=over)
+            else:
+                np.greater(part, level, out=over)
 
+            if use_rise:
+                np.less(over[:-1], over[1:], out=edge)
+            else:
+                np.greater(over[:-1], over[1:], out=edge)
 
-def get_rtime(trigs, hits):
-    min_time = 0
-    max_time = 346
+            index = np.flatnonzero(edge)
+            if len(index)!=0:
+                found.append(index.astype(np.int64) + start)
 
-    tdiffs = []
+        if len(found)==0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(found)
 
-    hit_index = 0
-    for i in range(len(trigs)):
-        while hits[hit_index]<(trigs[i]+max_time) and hit_index<len(hits)-1:
+_finders = threading.local()
+def get_crossing_finder()->CrossingFinder:
+    """
+        Each thread gets its own finder (and scratch space)
+    """
+    if not hasattr(_finders, "finder"):
+        _finders.finder = CrossingFinder()
+    return _finders.finder
 
-            # now the hit_index is the hit just after the trig we're on
-            dif = hits[hit_index] - trigs[i]
-            if dif>min_time and dif<max_time:
-                tdiffs.append(dif)                
+def get_cfd_time(signal, threshold, auto_adjust_ped = False, use_rise=False, negative=False, ped=0):
+    """
+        Finds the sample indices where `signal` crosses `threshold` above the pedestal
+        Multiply by the sample interval to get times; there's no need to build the whole time axis 
 
-            hit_index+=1
+        `negative` looks for the signal going below -threshold instead, so negative pulses don't need to be flipped first
+        `use_rise` keeps the crossings into the pulse, otherwise we keep the crossings back out of it 
 
-    return tdiffs 
+        The signal can be in mV or in raw ADC counts, the threshold and `ped` just need to be in the same units 
+    """
+    finder = get_crossing_finder()
+    if auto_adjust_ped:
+        ped = finder.pedestal(signal, ped, 0.66*threshold)
 
+    level = get_level(ped, threshold, negative, signal.dtype)
+    return finder.crossings(signal, level, negative, use_rise)
 
-def get_valid(trigs, hits, is_rec, invalid=False):
-    window = 24
-    if invalid:
-        shift = 150
+def get_level(ped, threshold, negative, dtype):
+    """
+        The level a signal needs to cross. For integer signals we round it so comparisons can stay in integers 
+    """
+    if negative:
+        level = ped - threshold
+        if np.issubdtype(dtype, np.integer):
+            level = int(np.ceil(level))
     else:
-        shift = 0
-    if is_rec:
-        min_time = 104+shift
-        max_time = min_time+window
+        level = ped + threshold
+        if np.issubdtype(dtype, np.integer):
+            level = int(np.floor(level))
+    return level
+
+
+def _rtime_pairs(trigs, hits, min_time, max_time, dt):
+    """
+        Time differences (in ns) for every (trigger, hit) pair more than `min_time` but less than `max_time` apart 
+    """
+    lo = np.searchsorted(hits, trigs + min_time/dt, side="right")
+    hi = np.searchsorted(hits, trigs + max_time/dt, side="left")
+    per_trig = np.maximum(hi - lo, 0)
+    total = int(np.sum(per_trig))
+    if total==0:
+        return np.zeros(0)
+
+    # hit index for each pair: the trigger's first hit, plus how far into that trigger's run of pairs we are
+    trig_index = np.repeat(np.arange(len(trigs)), per_trig)
+    run_start = np.cumsum(per_trig) - per_trig
+    hit_index = lo[trig_index] + np.arange(total) - run_start[trig_index]
+    return (hits[hit_index] - trigs[trig_index])*dt
+
+def get_rtime(trigs, hits, min_time=0, max_time=346, bins=None, dt=1.):
+    """
+        Time from every trigger to every hit that follows it within (`min_time`, `max_time`) ns. Both have to be sorted
+        `trigs` and `hits` can be times in ns, or sample indices with `dt` the sample interval in ns 
+
+        If `bins` (a number of bins, or the bin edges) is given, returns the histogram and edges instead of the differences. 
+        Those are filled a chunk of triggers at a time, so there's never a list of every pair 
+    """
+    trigs = np.asarray(trigs)
+    hits = np.asarray(hits)
+    if bins is None:
+        return _rtime_pairs(trigs, hits, min_time, max_time, dt)
+
+    if np.ndim(bins)==0:
+        edges = np.linspace(min_time, max_time, int(bins)+1)
     else:
-        min_time = 12+shift
-        max_time = min_time+window
+        edges = np.asarray(bins, dtype=float)
+    counts = np.zeros(len(edges)-1, dtype=int)
+    for start in range(0, len(trigs), CHUNK_SAMPLES):
+        counts += np.histogram(_rtime_pairs(trigs[start:start+CHUNK_SAMPLES], hits, min_time, max_time, dt), edges)[0]
+    return counts, edges
+
+class TimingHistogram:
+    """
+        Running histogram of the trigger-to-hit times on one channel, so the timing windows can be watched capture by capture 
+    """
+    def __init__(self, bins=173, min_time=0, max_time=346):
+        self.min_time = min_time
+        self.max_time = max_time
+        self.edges = np.linspace(min_time, max_time, bins+1) if np.ndim(bins)==0 else np.asarray(bins, dtype=float)
+        self.counts = np.zeros(len(self.edges)-1, dtype=int)
+
+    def add(self, trigs, hits, dt=1.):
+        self.counts += get_rtime(trigs, hits, self.min_time, self.max_time, self.edges, dt)[0]
+
+    def reset(self):
+        self.counts[:] = 0
+
+# (offset, width) in ns of the coincidence windows after a trigger
+MON_WINDOW = (12, 24)
+REC_WINDOW = (104, 24)
+# the dark windows are the same, shifted this far out
+DARK_SHIFT = 150
+# mon, rec, mon dark, rec dark
+COUNT_WINDOWS = np.array([MON_WINDOW, REC_WINDOW, (MON_WINDOW[0]+DARK_SHIFT, MON_WINDOW[1]), (REC_WINDOW[0]+DARK_SHIFT, REC_WINDOW[1])], dtype=float)
+
+def trigger_delays(trigs, hits, dt=1.):
+    """
+        Time (in ns) from each hit back to the latest trigger at or before it. Hits with no trigger before them get NaN
+        Both have to be sorted. It's one merge of the two: a single searchsorted, not a pass per window
+    """
+    hits = np.asarray(hits)
+    index = np.searchsorted(trigs, hits, side="right") - 1
+    delays = np.full(len(hits), np.nan)
+    matched = index>=0
+    delays[matched] = (hits[matched] - np.asarray(trigs)[index[matched]])*dt
+    return delays
+
+def coincidences(trigs, channels, windows, dt=1.):
+    """
+        Counts the hits on each of the `channels` landing in each of the (offset, width) `windows` after their preceding trigger 
+        The windows are open intervals, in ns. `trigs` and the hits are sorted sample indices, with `dt` the sample interval in ns
+
+        Each hit is matched to its trigger once, then the delays are sorted so every window is just two binary searches. 
+        So adding windows (or channels) costs next to nothing over the matching 
+
+        Returns an (n_channels, n_windows) array of counts
+    """
+    windows = np.asarray(windows, dtype=float).reshape(-1, 2)
+    counts = np.zeros((len(channels), len(windows)), dtype=int)
+    if len(trigs)==0:
+        return counts
+
+    for i, hits in enumerate(channels):
+        delays = trigger_delays(trigs, hits, dt)
+        delays = np.sort(delays[np.isfinite(delays)])
+        counts[i] = np.searchsorted(delays, windows[:,0]+windows[:,1], side="left") - np.searchsorted(delays, windows[:,0], side="right")
+    return counts
+
+def get_valid(trigs, hits, is_rec, invalid=False, dt=1.):
+    """
+        Which hits land in the monitor/receiver window (in ns) after the preceding trigger
+        `trigs` and `hits` can be times in ns, or sample indices with `dt` the sample interval in ns 
+    """
+    offset, width = REC_WINDOW if is_rec else MON_WINDOW
+    if invalid:
+        offset += DARK_SHIFT
 
-    hit_trig_time = hits - trigs[np.digitize(hits, trigs)-1]
-    good = np.logical_and( hit_trig_time>min_time, hit_trig_time<max_time)
+    if len(trigs)==0:
+        good = np.zeros(len(hits), dtype=bool)
+        return good, np.logical_not(good)
+
+    delays = trigger_delays(trigs, hits, dt)
+    with np.errstate(invalid="ignore"):
+        good = np.logical_and(delays>offset, delays<offset+width)
     return good, np.logical_not(good)
 
+def count_coincident(ctime, chanb, chand, mon_thresh, rec_thresh, dt, mon_ped=0, rec_ped=0, timing=None, timer=NULL_TIMER):
+    """
+        Counts the monitor hits, receiver hits, monitor dark hits, and receiver dark hits, against the triggers at `ctime`
+        The hits are found once per channel, then every window (dark ones too) is counted in one go 
+
+        `timing` can be a (monitor, receiver) pair of TimingHistograms to fill from the same hits 
+    """
+    with timer.time("crossings"):
+        mon_hits = get_cfd_time(chanb, mon_thresh, auto_adjust_ped=True, use_rise=False, negative=True, ped=mon_ped)
+        rec_hits = get_cfd_time(chand, rec_thresh, auto_adjust_ped=True, use_rise=False, negative=True, ped=rec_ped)
+    with timer.time("coincidence"):
+        counts = coincidences(ctime, (mon_hits, rec_hits), COUNT_WINDOWS, dt)
+        if timing is not None:
+            timing[0].add(ctime, mon_hits, dt)
+            timing[1].add(ctime, rec_hits, dt)
+    return int(counts[0][0]), int(counts[1][1]), int(counts[0][2]), int(counts[1][3])
+
+def count_block(chana, chanb, chand, trig_level, mon_thresh, rec_thresh, dt, mon_ped=0, rec_ped=0, timing=None, timer=NULL_TIMER):
+    """
+        Counts the triggers, monitor hits, receiver hits, monitor dark hits, and receiver dark hits in one capture 
+        Everything is in sample indices, only the time differences get scaled to ns (by `dt`)
+
+        `timing` can be a (monitor, receiver) pair of TimingHistograms to fill from the same hits, and `timer` a StageTimer
+    """
+    with timer.time("crossings"):
+        ctime = get_cfd_time(chana, trig_level, auto_adjust_ped=False, use_rise=True)
+    return (len(ctime), *count_coincident(ctime, chanb, chand, mon_thresh, rec_thresh, dt, mon_ped, rec_ped, timing, timer))
+
+def window_samples(window, dt=1.):
+    """
+        The [first, last) sample offsets from a trigger that land inside the open (offset, width) `window` in ns
+    """
+    offset, width = window
+    return int(np.floor(offset/dt))+1, int(np.ceil((offset+width)/dt))
+
+def pulse_amplitudes(trigs, signal, windows, ped=0, dt=1.):
+    """
+        How far `signal` dips below `ped` inside each of the (offset, width) `windows` after every trigger. The pulses are negative, so these come out positive
+        Every trigger gets a value for every window, even when there's no pulse (then it's just noise around zero)
+
+        Returns a (n_windows, n_trigs) array. Triggers too close to the end of the signal for the latest window are left out,
+        so that's fewer than len(trigs) columns
+    """
+    windows = np.asarray(windows, dtype=float).reshape(-1, 2)
+    edges = [window_samples(window, dt) for window in windows]
+    trigs = np.asarray(trigs)
+    trigs = trigs[trigs + max(stop for _, stop in edges) <= len(signal)]
+
+    amplitudes = np.zeros((len(windows), len(trigs)))
+    for i, (start, stop) in enumerate(edges):
+        if len(trigs)==0:
+            break
+        view = np.lib.stride_tricks.sliding_window_view(signal, stop-start)
+        amplitudes[i] = ped - np.min(view[trigs+start], axis=1)
+    return amplitudes
+
+# the deepest point on each channel is looked for this far (ns) after its trigger, everything before the dark windows.
+# So the coincidence windows can be moved around later, as cuts on the time
+SEARCH_WINDOW = (0, DARK_SHIFT)
+
+# flags on a pulse record
+FLAG_MON = 1
+FLAG_REC = 2
+FLAG_MON_DARK = 4
+FLAG_REC_DARK = 8
+# the scope saw an input go over its range, somewhere in the measurement so far
+FLAG_SATURATED = 16
+
+# one of these per trigger. Times are ns after the trigger, amplitudes below the pedestal, charges that times ns
+PULSE_DTYPE = np.dtype([
+    ("trig", np.int64),
+    ("mon_amp", np.float32),
+    ("mon_time", np.float32),
+    ("mon_charge", np.float32),
+    ("rec_amp", np.float32),
+    ("rec_time", np.float32),
+    ("rec_charge", np.float32),
+    ("mon_dark_amp", np.float32),
+    ("rec_dark_amp", np.float32),
+    ("flags", np.uint8),
+])
+
+def _deepest(trigs, signal, window, ped, dt):
+    """
+        How far below `ped`, and when (ns after the trigger), `signal` is at its lowest in `window` after each trigger
+    """
+    start, stop = window_samples(window, dt)
+    samples = np.lib.stride_tricks.sliding_window_view(signal, stop-start)[trigs+start]
+    index = np.argmin(samples, axis=1)
+    return ped - samples[np.arange(len(trigs)), index], (index+start)*dt
+
+def _charge(trigs, signal, window, ped, dt):
+    """
+        Area between `ped` and `signal` in `window` after each trigger
+    """
+    start, stop = window_samples(window, dt)
+    samples = np.lib.stride_tricks.sliding_window_view(signal, stop-start)[trigs+start]
+    return ((stop-start)*ped - np.sum(samples, axis=1, dtype=np.float64))*dt
+
+def pulse_records(trigs, chanb, chand, mon_thresh, rec_thresh, dt, mon_ped=0, rec_ped=0, offset=0):
+    """
+        One PULSE_DTYPE record per trigger, with the monitor and receiver pulse heights, times and charges after it
+        The pedestals get adjusted the same way as for counting, and the flags are whether each window has a pulse over threshold
+
+        `offset` gets added to the trigger sample indices, so records from consecutive blocks can be told apart
+        Triggers too close to the end of the capture to see all the windows are left out
+    """
+    finder = get_crossing_finder()
+    mon_ped = finder.pedestal(chanb, mon_ped, 0.66*mon_thresh)
+    rec_ped = finder.pedestal(chand, rec_ped, 0.66*rec_thresh)
+
+    windows = np.concatenate([COUNT_WINDOWS, [SEARCH_WINDOW]])
+    trigs = np.asarray(trigs)
+    trigs = trigs[trigs + max(window_samples(window, dt)[1] for window in windows) <= min(len(chanb), len(chand))]
+
+    records = np.zeros(len(trigs), dtype=PULSE_DTYPE)
+    if len(trigs)==0:
+        return records
+    records["trig"] = trigs + offset
+    records["mon_amp"], records["mon_time"] = _deepest(trigs, chanb, SEARCH_WINDOW, mon_ped, dt)
+    records["rec_amp"], records["rec_time"] = _deepest(trigs, chand, SEARCH_WINDOW, rec_ped, dt)
+    records["mon_charge"] = _charge(trigs, chanb, MON_WINDOW, mon_ped, dt)
+    records["rec_charge"] = _charge(trigs, chand, REC_WINDOW, rec_ped, dt)
+
+    mon = pulse_amplitudes(trigs, chanb, COUNT_WINDOWS[[0, 2]], mon_ped, dt)
+    rec = pulse_amplitudes(trigs, chand, COUNT_WINDOWS[[1, 3]], rec_ped, dt)
+    records["mon_dark_amp"] = mon[1]
+    records["rec_dark_amp"] = rec[1]
+    records["flags"] = (FLAG_MON*(mon[0]>mon_thresh) | FLAG_REC*(rec[0]>rec_thresh)
+                        | FLAG_MON_DARK*(mon[1]>mon_thresh) | FLAG_REC_DARK*(rec[1]>rec_thresh))
+    return records
+
+def threshold_counts(amplitudes, thresholds):
+    """
+        For each threshold, how many of the `amplitudes` are over it. One sort, then a binary search per threshold
+    """
+    amplitudes = np.sort(np.asarray(amplitudes).ravel())
+    return len(amplitudes) - np.searchsorted(amplitudes, thresholds, side="right")
+
+class BufferArena:
+    """
+        One block of memory holding all of the capture buffers for an acquisition configuration. The buffers are numpy views into it
+        `layout` maps each buffer's name to its shape. Every buffer starts on an `align`-byte boundary 
+
+        The block is an anonymous mmap, so it's page aligned and nothing gets touched until the scope writes to it. 
+        With `hugepages` we ask the kernel to back it with transparent huge pages (Linux only, ignored elsewhere)
+    """
+    def __init__(self, layout, dtype=np.int16, align=4096, hugepages=False):
+        self.layout = {name:tuple(np.atleast_1d(shape).tolist()) for name, shape in layout.items()}
+        self.dtype = np.dtype(dtype)
+        self.hugepages = hugepages
+
+        offsets = {}
+        self.nbytes = 0
+        for name, shape in self.layout.items():
+            offsets[name] = self.nbytes
+            size = int(np.prod(shape))*self.dtype.itemsize
+            self.nbytes += -(-size//align)*align
+
+        self._block = mmap.mmap(-1, max(self.nbytes, 1))
+        if hugepages and hasattr(mmap, "MADV_HUGEPAGE"):
+            self._block.madvise(mmap.MADV_HUGEPAGE)
+        self._views = {name:np.ndarray(shape, dtype=self.dtype, buffer=self._block, offset=offsets[name]) for name, shape in self.layout.items()}
+
+    def __getitem__(self, name)->np.ndarray:
+        return self._views[name]
+
+    def matches(self, layout, hugepages=False):
+        """
+            Whether this arena already has exactly this layout, so it can be reused
+        """
+        return self.hugepages==hugepages and self.layout=={name:tuple(np.atleast_1d(shape).tolist()) for name, shape in layout.items()}
+
+class BlockReady:
+    """
+        Lets us wait on the driver's block-ready callback, rather than sleep-polling ps3000aIsReady
+        
+        Pass `arm()` as the lpReady argument of ps3000aRunBlock, then `wait()` for the block
+        `driver` is whatever is standing in for ps3000a
+    """
+    def __init__(self, timeout=10., driver=ps):
+        self.timeout = timeout
+        self.status = 0
+        self._event = threading.Event()
+        # hold on to this, or the C function pointer gets garbage collected out from under the driver 
+        self._callback = driver.BlockReadyType(self._ready)
+
+    def _ready(self, handle, status, param):
+        self.status = status
+        self._event.set()
+
+    def arm(self):
+        self._event.clear()
+        return self._callback
+
+    def wait(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        if not self._event.wait(timeout):
+            raise TimeoutError("Block not ready after {} s".format(timeout))
+        assert_pico_ok(self.status)
+
+class StreamCounter:
+    """
+        Counts the triggers, monitor/receiver hits, and dark hits in a stream that arrives in chunks
+
+        Everything that matters at the edge of a chunk is carried over to the next one: 
+            the last sample on each channel (for crossings across the edge), 
+            the last trigger (for hits just after the edge), 
+            and the running pedestals 
+        So crossings and coincidences across the edges aren't lost. The pedestal is a running mean though, so each chunk is 
+        counted against the pedestal of the stream so far rather than of the whole stream. While the pedestal holds steady 
+        that makes no difference (in ADC counts the levels round to the same thing), and the counts are the same as analysing 
+        the whole stream in one go. If it drifts, the early chunks lag behind where a single pass would have put it
+    """
+    def __init__(self, trig_level, mon_thresh, rec_thresh, dt, mon_ped=0, rec_ped=0):
+        self.trig_level = trig_level
+        self.thresholds = [mon_thresh, rec_thresh]
+        self.dt = dt
+        self._start_peds = [mon_ped, rec_ped]
+        self._ped_sums = [0., 0.]
+        self._ped_counts = [0, 0]
+
+        # index of the next sample we expect 
+        self.offset = 0
+        self.samples = 0
+        self.counts = np.zeros(5, dtype=int)
+        self._forget()
+
+    def _forget(self):
+        """
+            Drop the state carried across the edge. Used when a chunk goes missing 
+        """
+        self._previous = [None, None, None]
+        self._last_trig = None
+
+    def add(self, chana, chanb, chand, start=None):
+        """
+            Analyse the next chunk. `start` is the index of its first sample in the stream, if it doesn't follow on from the last one 
+        """
+        if start is not None and start!=self.offset:
+            self._forget()
+            self.offset = start 
+        finder = get_crossing_finder()
+
+        trigs = finder.crossings(chana, self.trig_level, False, True, self._previous[0]) + self.offset
+        if self._last_trig is not None:
+            # hits at the start of this chunk may belong to a trigger at the end of the last 
+            all_trigs = np.concatenate(([self._last_trig], trigs))
+        else:
+            all_trigs = trigs
+
+        all_hits = []
+        for i, chan in enumerate((chanb, chand)):
+            total, count = finder.pedestal_sums(chan, self._start_peds[i], 0.66*self.thresholds[i])
+            self._ped_sums[i] += total
+            self._ped_counts[i] += count
+            ped = self._ped_sums[i]/self._ped_counts[i] if self._ped_counts[i]!=0 else self._start_peds[i]
+
+            level = get_level(ped, self.thresholds[i], True, chan.dtype)
+            all_hits.append(finder.crossings(chan, level, True, False, self._previous[i+1]) + self.offset)
+        counts = coincidences(all_trigs, all_hits, COUNT_WINDOWS, self.dt)
+
+        # order to match everywhere else: triggers, monitor, receiver, monitor dark, receiver dark 
+        self.counts += [len(trigs), counts[0][0], counts[1][1], counts[0][2], counts[1][3]]
+
+        if len(all_trigs)!=0:
+            self._last_trig = all_trigs[-1]
+        if len(chana)!=0:
+            self._previous = [chana[-1], chanb[-1], chand[-1]]
+        self.offset += len(chana)
+        self.samples += len(chana)
+
+def _segment_crossings(signal):
+    """
+        (segment, index) of every sign change along each row of `signal`. Like np.argwhere(np.diff(np.sign(row))) on each row
+    """
+    return np.nonzero(np.diff(np.sign(signal), axis=1))
+
+def _segment_peaks(signal, height):
+    """
+        (segment, index) of the local maxima at least `height` tall along each row of `signal`
+        Same peaks as scipy's find_peaks(row, height=height) on each row: flat tops count once, at their middle 
+    """
+    # a peak is a rise followed by a fall, with only flat steps in between
+    segment, step = np.nonzero(np.diff(signal, axis=1))
+    rising = signal[segment, step+1] > signal[segment, step]
+    top = np.flatnonzero(rising[:-1] & ~rising[1:] & (segment[:-1]==segment[1:]))
+    segment = segment[top]
+    index = (step[top] + 1 + step[top+1])//2
+    tall = signal[segment, index] >= height
+    return segment[tall], index[tall]
+
 class ReturnType(Enum):
     PulseCount = 0
     Amplitudes = 1
@@ -103,6 +584,14 @@ class Scope(ContextDecorator):
         self._max_offset = 150
         self._time_per_sample = -1
 
+        # how long, in seconds, we'll wait for a block before giving up 
+        self._ready = BlockReady(timeout=1.)
+
+        # the min buffers are only filled when aggregating, so they're only allocated then
+        self.ratio_mode = ps.PS3000A_RATIO_MODE["PS3000A_RATIO_MODE_NONE"]
+        self.hugepages = False
+        self._arena = None
+
     def __exit__(self, *exc):
         """
         We stop and close the connection to the picoscope 
@@ -136,6 +625,15 @@ class Scope(ContextDecorator):
         assert_pico_ok(status)
         status=ps.ps3000aSetNoOfCaptures(self.chandle, n_segments)
         assert_pico_ok(status)
+
+        # one arena for all of the enabled channels, kept as long as they don't change
+        layout = {}
+        for channel in self._channels.values():
+            layout.update(channel.layout(self.ratio_mode))
+        if self._arena is None or not self._arena.matches(layout, self.hugepages):
+            self._arena = BufferArena(layout, hugepages=self.hugepages)
+        for channel in self._channels.values():
+            channel.attach(self._arena)
         self._prepared = True 
 
     def enable_channel(self, channo, collect=True, pulse_threshold=25):
@@ -167,123 +665,75 @@ class Scope(ContextDecorator):
         if not self._prepared:
             self._prepare()
 
-        n_chan = len(list(self._channels.keys()))
-
-        ps.ps3000aRunBlock(self.chandle, 0, MAXSAMPLES, 2, 1, None, 0, None, None)
-
-        peaks = [0 for _ in self._channels.keys()]
-        amps = [[] for _ in self._channels.keys()]
-        times = [[] for _ in self._channels.keys()]
+        status = ps.ps3000aRunBlock(self.chandle, 0, MAXSAMPLES, 2, 1, None, 0, self._ready.arm(), None)
+        assert_pico_ok(status)
 
-        for ic, chankey in enumerate(self._channels.keys()):
-            for bx in range(len(self._channels[chankey].bufmin)):
-                
+        for chankey in self._channels.keys():
+            channel = self._channels[chankey]
+            for bx in range(len(channel.bufmax)):
                 buffer_no = bx #+ic*len(self._channels[chankey].bufmin)
-                status = ps.ps3000aSetDataBuffers(self.chandle, chankey, self._channels[chankey].bufmax[bx].ctypes.data, self._channels[chankey].bufmin[bx].ctypes.data, MAXSAMPLES, buffer_no, ps.PS3000A_RATIO_MODE["PS3000A_RATIO_MODE_NONE"] )
+                bufmin = None if channel.bufmin is None else channel.bufmin[bx].ctypes.data
+                status = ps.ps3000aSetDataBuffers(self.chandle, chankey, channel.bufmax[bx].ctypes.data, bufmin, MAXSAMPLES, buffer_no, self.ratio_mode )
                 assert_pico_ok(status)
 
-        ready = ctypes.c_int(0)
-        check = ctypes.c_int(0)
-        bad_count =0
-        while ready.value==check.value:
-            status = ps.ps3000aIsReady(self.chandle, ctypes.byref(ready))
-            pytime.sleep(0.02)
-            if bad_count>40:
-                assert_pico_ok(status)  
-                if status==0:
-                    break
-                raise ValueError()
-            bad_count+=1
-
-        status = ctypes.c_int(1)
-        while status!=0:
-            # ps.ps3000aGetValuesBulk(chandle, ctypes.byref(cmaxSamples), 0, 9, 1, 0, ctypes.byref(overflow))
-            status = ps.ps3000aGetValuesBulk(self.chandle, ctypes.byref(cmaxSamples), 0, 9,  0, ps.PS3000A_RATIO_MODE["PS3000A_RATIO_MODE_NONE"] , ctypes.byref(overflow))
-            pytime.sleep(0.05)
+        self._ready.wait()
+
+        # ps.ps3000aGetValuesBulk(chandle, ctypes.byref(cmaxSamples), 0, 9, 1, 0, ctypes.byref(overflow))
+        status = ps.ps3000aGetValuesBulk(self.chandle, ctypes.byref(cmaxSamples), 0, 9,  0, self.ratio_mode , ctypes.byref(overflow))
         assert_pico_ok(status)  
         status = ps.ps3000aMaximumValue(self.chandle, ctypes.byref(maxADC))
         assert_pico_ok(status)
-        pytime.sleep(0.25)
-
 
-        for ic, chankey in enumerate(self._channels.keys()):  
+        # each channel is one (segments x samples) array, and everything below works on all the segments at once
+        peaks = []
+        amps = []
+        times = []
+        for ic, chankey in enumerate(self._channels.keys()):
             sign = 1 if chankey==0 else -1
-            for i in range(10):
-                parsed = adc2mV(self._channels[chankey].bufmax[i], chARange, maxADC)
-                #plt.plot(range(len(parsed)), sign*np.array(parsed), alpha=0.2)
-                
-                # find_peks returns only the index of the peaks, so we need to extrapolate out to get a time
-                # and then also consider that each of these samples are sequential
-
-
-                # on signal is 170ns, off is 200ns 
-                if ic==0:
-                    # we get the time when the trigger signal crosses the axis
-                    crossings = np.argwhere(np.diff(np.sign(sign*np.array(parsed) - self._threshs[chankey]))).flatten()
-                    if len(crossings)<1 or len(crossings)<2:
-                        continue
-                    start_on = crossings[1] - crossings[0] < 180
-                    if start_on:
-                        crossings = crossings[np.array(range(len(crossings)))%2==0]
-                    else:
-                        crossings = crossings[np.array(range(len(crossings)))%2==1]
-
-                    shifted_times = np.array(crossings)*self._time_per_sample + i*self._time_per_sample*len(parsed)
-                    peaks[ic] += len(shifted_times)
-                    amps[ic] += list(np.array(parsed)[crossings]) 
-
-                else:
-                    peakfind = find_peaks(sign*np.array(parsed), height=self._threshs[chankey])
-                    shifted_times = np.array(peakfind[0])*self._time_per_sample + i*self._time_per_sample*len(parsed)
-                    peaks[ic] += len(peakfind[0])
-                    amps[ic] += list(peakfind[1]["peak_heights"])
-                times[ic] += shifted_times.tolist() 
-
-       # print(times[2][:10])
-        accepted = [[], []]
+            parsed = self.adc2mV(self._channels[chankey].bufmax, maxADC.value)
+            n_samples = parsed.shape[1]
+
+            # on signal is 170ns, off is 200ns 
+            if ic==0:
+                # we get the time when the trigger signal crosses the axis
+                segment, index = _segment_crossings(sign*parsed - self._threshs[chankey])
+
+                # keep every other crossing, starting from the first or second depending on whether the segment starts with the signal on
+                per_segment = np.bincount(segment, minlength=parsed.shape[0])
+                first = np.cumsum(per_segment) - per_segment
+                rank = np.arange(len(index)) - first[segment]
+                start_on = np.zeros(parsed.shape[0], dtype=bool)
+                usable = per_segment>=2
+                start_on[usable] = (index[first[usable]+1] - index[first[usable]]) < 180
+                keep = usable[segment] & ((rank%2==0)==start_on[segment])
+                segment = segment[keep]
+                index = index[keep]
+                amps.append(parsed[segment, index])
+            else:
+                segment, index = _segment_peaks(sign*parsed, self._threshs[chankey])
+                amps.append(sign*parsed[segment, index])
+
+            peaks.append(len(index))
+            times.append((index + segment*n_samples)*self._time_per_sample)
 
+        accepted = [np.zeros(len(entry), dtype=bool) for entry in times[1:]]
         if len(times[0]) >0:
-            # iterate over the pulse times for channels
-            for i, pulse_time in enumerate(times[1]):
-                # binary search to find the trigger pulses bordering this one
-                index = np.searchsorted(times[0], pulse_time)-1  # minus one to get the proper index of the proceeding pulse 
-                if index>=len(times[0]):
-                    index = len(times[0])-1
-                
-                tdiff = pulse_time - times[0][index]
-          
-                #accepted[0].append( tdiff>self._min_offset and tdiff<self._max_offset )
-                accepted[0].append(True)
-            
-            for i, pulse_time in enumerate(times[2]):
-                index = np.searchsorted(times[0], pulse_time)-1  # minus one to get the proper index of the proceeding pulse 
-                if index>=len(times[0]):
-                    index=len(times[0])-1
-                tdiff = pulse_time - times[0][index]
-                accepted[1].append(True)
-                #accepted[1].append( tdiff>self._min_offset and tdiff<self._max_offset )
-        accepted =[np.array(accepted[0]), np.array(accepted[1])]
-        amps = [np.array(entry) for entry in amps ]
-
-            #return self._channels[chankey].bufmax[i], self._channels[chankey].bufmin[i]
-            #plt.show()
+            for ic, pulse_times in enumerate(times[1:]):
+                # the trigger pulse just before each of these 
+                index = np.clip(np.searchsorted(times[0], pulse_times)-1, 0, len(times[0])-1)
+                tdiff = pulse_times - times[0][index]
+                #accepted[ic] = np.logical_and(tdiff>self._min_offset, tdiff<self._max_offset)
+                accepted[ic][:] = True
+
         if return_kind.value==ReturnType.PulseCount.value:
-            #return peaks[0], times[0], times[1]
-            if np.sum(accepted[0].astype(int))==0:
-                acc0 = 0
-            else:
-                acc0 = len(amps[1][accepted[0]])
-            if np.sum(accepted[1].astype(int))==0:
-                acc1=0
-            else:
-                acc1 = len(amps[2][accepted[1]])
-            return peaks[0], acc0, acc1
+            return peaks[0], int(np.count_nonzero(accepted[0])), int(np.count_nonzero(accepted[1]))
 
         elif return_kind.value==ReturnType.Amplitudes.value:
             return peaks[0], amps[1][accepted[0]], amps[2][accepted[1]]
 
     def adc2mV(self, bufferADC, maxADC):
-        bufferV = bufferADC*channelInputRanges[chARange]/maxADC
+        # scale factor first, so int16 buffers come out as floats rather than overflowing
+        bufferV = bufferADC*(channelInputRanges[chARange]/maxADC)
         return bufferV
 
 class Channel:
@@ -297,7 +747,20 @@ class Channel:
             channel - 0, 1, 2, 3 
             for A, B, C, and D 
         """
- 
-        self.bufmin = [np.empty(MAXSAMPLES,dtype=np.dtype('int16')) for i in range(10)]
-        self.bufmax = [np.empty(MAXSAMPLES,dtype=np.dtype('int16')) for i in range(10)]
-        
+        self.channel = channel
+        # (segments x samples) views into the scope's BufferArena, set once the scope is prepared. Rows are the per-segment buffers 
+        self.bufmin = None
+        self.bufmax = None
+
+    def layout(self, ratio_mode):
+        """
+            The buffers this channel needs in the arena
+        """
+        layout = {(self.channel, "max"):(nbuf, MAXSAMPLES)}
+        if ratio_mode==ps.PS3000A_RATIO_MODE["PS3000A_RATIO_MODE_AGGREGATE"]:
+            layout[(self.channel, "min")] = (nbuf, MAXSAMPLES)
+        return layout
+
+    def attach(self, arena:BufferArena):
+        self.bufmax = arena[(self.channel, "max")]
+        self.bufmin = arena[(self.channel, "min")] if (self.channel, "min") in arena.layout else None